@@ -1,9 +1,16 @@
 from fastapi import FastAPI, HTTPException, Request, Depends, Cookie, Response
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.concurrency import run_in_threadpool
+import anyio.to_thread
 from pydantic import BaseModel, Field
-from typing import List, Dict, Optional
-import uuid
+from typing import List, Dict, Optional, Tuple
+import hashlib
+import os
+import secrets
+import time
 import logging
+import orjson
+from itsdangerous import BadSignature, Signer
 
 # Import recommendation and session logic from other modules
 from . import recommend
@@ -26,6 +33,9 @@ class RecommendationResponse(BaseModel):
 class ChoiceRequest(BaseModel):
     movieId: int
 
+class MessageResponse(BaseModel):
+    message: str
+
 # --- FastAPI App Initialization ---
 app = FastAPI(
     title="Movie Recommender API",
@@ -46,36 +56,99 @@ app.add_middleware(
     allow_headers=["*"], # Allows all headers
 )
 
+# --- Thread Pool ---
+# Sync endpoints and blocking calls (Redis, recommendation scoring) run in AnyIO's
+# worker threads so they don't block the event loop. Default limit is 40 threads.
+THREADPOOL_SIZE = 128
+
+# --- JSON Serialization ---
+# Endpoints that return data declare a response_model: FastAPI then serializes the
+# result straight to JSON bytes with Pydantic's Rust core (faster than orjson via
+# ORJSONResponse, which is deprecated for this reason). Setting a custom
+# default_response_class would turn that fast path off. Pre-encoded bodies
+# below use orjson directly.
+
+# --- HTTP Response Caching ---
+# /genres never changes while the process runs, and /random only needs to be fresh
+# every few seconds, so both serve pre-encoded JSON bodies with an ETag and
+# Cache-Control headers that let browsers and CDNs reuse them.
+GENRES_MAX_AGE = 3600 # Seconds clients may cache /genres
+RANDOM_MAX_AGE = 60 # Seconds a /random sample is reused (server-side and by clients)
+
+def _etag(body: bytes) -> str:
+    """Strong ETag derived from the response body."""
+    return f'"{hashlib.blake2b(body, digest_size=16).hexdigest()}"'
+
+def _cached_json_response(request: Request, body: bytes, etag: str, max_age: int) -> Response:
+    """Returns the JSON body, or 304 Not Modified if the client already has this ETag."""
+    headers = {"Cache-Control": f"public, max-age={max_age}", "ETag": etag}
+    if request.headers.get("if-none-match") == etag:
+        return Response(status_code=304, headers=headers)
+    return Response(content=body, media_type="application/json", headers=headers)
+
+GENRES_BODY = orjson.dumps({"genres": recommend.get_all_genres()})
+GENRES_ETAG = _etag(GENRES_BODY)
+
+# genre -> (expiry timestamp, body, etag) of the current random sample, in front of
+# the copy shared through Redis (see session.share_random_sample)
+_random_cache: Dict[str, Tuple[float, bytes, str]] = {}
+
 # --- Session ID Management ---
-# Use a cookie to manage the session ID
+# Use a signed cookie to manage the session ID, so forged or malformed cookies
+# are rejected before they reach Redis. Sessions are only created by /choice.
 SESSION_COOKIE_NAME = "reco_session_id"
+SESSION_SECRET = os.getenv("SESSION_SECRET")
+if not SESSION_SECRET:
+    # Shared by Gunicorn workers through preload_app, but sessions won't survive a restart
+    logger.warning("SESSION_SECRET not set. Using a random secret for signing session cookies.")
+    SESSION_SECRET = secrets.token_urlsafe(32)
+session_signer = Signer(SESSION_SECRET, salt="reco-session")
+
+def _verify_session_cookie(cookie: Optional[str]) -> Optional[str]:
+    """Returns the session ID inside a signed cookie value, or None if missing or invalid."""
+    if cookie is None:
+        return None
+    try:
+        return session_signer.unsign(cookie).decode()
+    except BadSignature:
+        logger.warning("Rejected session cookie with an invalid signature.")
+        return None
 
 async def get_session_id(
-    request: Request,
     response: Response,
-    session_id: Optional[str] = Cookie(None, alias=SESSION_COOKIE_NAME)
+    session_cookie: Optional[str] = Cookie(None, alias=SESSION_COOKIE_NAME)
 ) -> str:
     """
-    Retrieves session ID from cookie or creates a new one if not present.
-    Sets the cookie in the response.
+    Retrieves the session ID from the signed cookie or creates a new one if
+    missing or invalid. Sets the cookie in the response for new sessions.
     """
+    session_id = _verify_session_cookie(session_cookie)
     if session_id is None:
-        session_id = str(uuid.uuid4())
+        session_id = secrets.token_urlsafe(16)
         logger.info(f"New session created: {session_id}")
         # Set the cookie in the response. Max_age=None means it's a session cookie.
-        response.set_cookie(key=SESSION_COOKIE_NAME, value=session_id, httponly=True, samesite='lax') # httponly for security
+        response.set_cookie(key=SESSION_COOKIE_NAME, value=session_signer.sign(session_id).decode(),
+                            httponly=True, samesite='lax') # httponly for security
     else:
         logger.debug(f"Existing session found: {session_id}")
     return session_id
 
+async def get_existing_session_id(
+    session_cookie: Optional[str] = Cookie(None, alias=SESSION_COOKIE_NAME)
+) -> Optional[str]:
+    """Retrieves the session ID from the signed cookie without creating a new session."""
+    return _verify_session_cookie(session_cookie)
+
 # --- API Endpoints ---
 
 @app.on_event("startup")
 async def startup_event():
+    anyio.to_thread.current_default_thread_limiter().total_tokens = THREADPOOL_SIZE
+
     # Log model loading status on startup
     # Check if the data structures were initialized correctly in recommend.py
     # We set them to empty dict/None on loading failure there.
-    models_loaded = bool(recommend.similarity_lookup) and (recommend.genre_map_df is not None)
+    models_loaded = bool(recommend.sim_neighbors.size) and recommend.num_items > 0
 
     if not models_loaded:
         logger.critical("Models did not load correctly on startup. API might not function.")
@@ -85,25 +158,32 @@ async def startup_event():
          logger.warning("Redis connection failed on startup. Session features will not work.")
 
 @app.get("/genres", response_model=GenreListResponse)
-async def get_genres():
+async def get_genres(request: Request):
     """Returns a list of all available movie genres."""
     logger.info("Request received for /genres")
-    genres = recommend.get_all_genres()
-    if not genres:
+    if not recommend.all_genres:
          # This might happen if model loading failed
          logger.error("Genre list is empty, likely due to model loading issues.")
          raise HTTPException(status_code=500, detail="Failed to load genre data.")
-    return {"genres": genres}
+    return _cached_json_response(request, GENRES_BODY, GENRES_ETAG, GENRES_MAX_AGE)
 
 @app.get("/random", response_model=RecommendationResponse)
-async def get_random_movies(genre: str):
-    """Returns 20 random movies for a given genre."""
+def get_random_movies(request: Request, genre: str):
+    """
+    Returns 20 random movies for a given genre (runs in the thread pool).
+    The sample for each genre is reused for RANDOM_MAX_AGE seconds.
+    """
     logger.info(f"Request received for /random?genre={genre}")
     if not genre:
         raise HTTPException(status_code=400, detail="Genre parameter is required.")
 
+    cached = _random_cache.get(genre)
+    if cached is not None and cached[0] > time.monotonic():
+        _, body, etag = cached
+        return _cached_json_response(request, body, etag, RANDOM_MAX_AGE)
+
     random_movies = recommend.random_by_genre(genre, n=recommend.RECOMMENDATION_COUNT)
-    if not random_movies and genre not in recommend.get_all_genres():
+    if not random_movies and genre not in recommend.all_genres:
          raise HTTPException(status_code=404, detail=f"Genre '{genre}' not found.")
     elif not random_movies:
          # Genre exists but no movies found (unlikely but possible) or model loading issue
@@ -112,7 +192,14 @@ async def get_random_movies(genre: str):
          # Let's return empty list for now if genre exists but no movies found.
          pass
 
-    return {"recommendations": random_movies}
+    # Workers agree on one sample per genre through Redis, so every request within
+    # RANDOM_MAX_AGE gets the same body and ETag whichever worker serves it
+    body, remaining = session.share_random_sample(
+        genre, orjson.dumps({"recommendations": random_movies}), RANDOM_MAX_AGE
+    )
+    etag = _etag(body)
+    _random_cache[genre] = (time.monotonic() + remaining, body, etag)
+    return _cached_json_response(request, body, etag, RANDOM_MAX_AGE)
 
 @app.post("/choice", response_model=RecommendationResponse)
 async def post_choice(
@@ -130,22 +217,22 @@ async def post_choice(
          logger.warning(f"Movie ID {choice.movieId} not found in model data.")
          raise HTTPException(status_code=404, detail=f"Movie ID {choice.movieId} not found.")
 
-    # Push the choice to the session history (handled by session.py)
-    session.push_choice(session_id, choice.movieId)
-
-    # Get the updated history
-    history_ids = session.get_mem(session_id)
+    # Push the choice to the session history and get the updated history in one Redis round-trip
+    history_ids = await run_in_threadpool(session.push_and_get, session_id, choice.movieId)
 
-    # Get recommendations based on history
-    recommendations = recommend.recommend_top_k(history_ids, n=recommend.RECOMMENDATION_COUNT)
+    # Get recommendations based on history, off the event loop
+    recommendations = await run_in_threadpool(
+        recommend.recommend_top_k, history_ids, n=recommend.RECOMMENDATION_COUNT
+    )
 
     return {"recommendations": recommendations}
 
-@app.post("/reset")
-async def reset_session(session_id: str = Depends(get_session_id)):
+@app.post("/reset", response_model=MessageResponse)
+async def reset_session(session_id: Optional[str] = Depends(get_existing_session_id)):
     """Clears the recommendation history for the current session."""
     logger.info(f"Request received for /reset (Session: {session_id})")
-    session.clear_session(session_id)
+    if session_id is not None:
+        await run_in_threadpool(session.clear_session, session_id) # Blocking Redis DELETE
     return {"message": "Session history cleared successfully."}
 
 # --- Main entry point for Uvicorn (if running this file directly) ---
@@ -0,0 +1,120 @@
+# Build, save and load the flat NumPy arrays the API serves recommendations from.
+# Shared by scripts/03_compute_sim.py (which prebuilds them) and app/recommend.py
+# (which memory-maps them at startup), so it must not load anything on import.
+
+import numpy as np
+import polars as pl
+from pathlib import Path
+from typing import Dict
+from .utils import get_logger
+
+logger = get_logger(__name__)
+
+# Similarities (cosine, within [-1, 1]) are stored as int16 scaled by this factor.
+# Recommendations only rank sums of a few scores, so the quantization doesn't change results
+# in practice, and it halves the memory read per neighbour.
+SIM_SCORE_SCALE = 32767
+
+# Every array stored in the artifact directory, one <name>.npy file each.
+# - sim_indptr/sim_neighbors/sim_scores: item-item similarities in CSR layout,
+#   neighbours of item i are sim_neighbors[sim_indptr[i]:sim_indptr[i + 1]],
+#   sim_scores are int16 (similarity * SIM_SCORE_SCALE)
+# - genre_names/genre_indptr/genre_items: items of genre_names[g] are
+#   genre_items[genre_indptr[g]:genre_indptr[g + 1]]
+# - movie_ids: movieId per item index (-1 where the index has no movie)
+# - title_offsets/title_bytes: UTF-8 title of item i is
+#   title_bytes[title_offsets[i]:title_offsets[i + 1]]
+ARRAY_NAMES = (
+    "sim_indptr", "sim_neighbors", "sim_scores",
+    "genre_names", "genre_indptr", "genre_items",
+    "movie_ids", "title_offsets", "title_bytes",
+)
+
+
+def quantize_scores(similarity: np.ndarray) -> np.ndarray:
+    """Maps similarities in [-1, 1] to int16 (similarity * SIM_SCORE_SCALE, rounded)."""
+    scaled = np.rint(np.clip(similarity, -1.0, 1.0) * SIM_SCORE_SCALE)
+    return scaled.astype(np.int16)
+
+
+def build_reco_arrays(sim_df: pl.DataFrame, genre_map_df: pl.DataFrame) -> Dict[str, np.ndarray]:
+    """Converts the similarity table and genre map into the flat serving arrays."""
+    num_items = int(genre_map_df["item_idx"].max()) + 1
+    genre_map_df = genre_map_df.sort("item_idx")
+    item_indices = genre_map_df["item_idx"].to_numpy()
+
+    # 1. Item index to movie ID and title
+    movie_ids = np.full(num_items, -1, dtype=np.int64)
+    movie_ids[item_indices] = genre_map_df["movieId"].to_numpy()
+    titles = genre_map_df["title"].fill_null("")
+    title_lengths = np.zeros(num_items, dtype=np.int64)
+    title_lengths[item_indices] = titles.str.len_bytes().to_numpy()
+    title_offsets = np.concatenate([[0], np.cumsum(title_lengths)]).astype(np.int64)
+    # Concatenated in one Polars call, not through a Python list of one str per title
+    title_bytes = np.frombuffer(titles.str.join("").item().encode("utf-8"), dtype=np.uint8)
+
+    # 2. Genre to item indices, grouped by Polars instead of a per-row Python loop
+    genre_groups = (
+        genre_map_df
+        .select("item_idx", pl.col("genres").str.split("|"))
+        .explode("genres")
+        .filter(pl.col("genres") != "(no genres listed)") # Skip this category
+        .group_by("genres")
+        .agg(pl.col("item_idx"))
+        .sort("genres")
+    )
+    genre_names = genre_groups["genres"].to_list()
+    genre_counts = genre_groups["item_idx"].list.len().to_numpy()
+    genre_indptr = np.concatenate([[0], np.cumsum(genre_counts)]).astype(np.int32)
+    genre_items = genre_groups["item_idx"].explode().to_numpy().astype(np.int32)
+
+    # 3. Similarities, sorted by similarity descending within each item
+    sim_df_sorted = sim_df.sort("item_idx_from", "similarity", descending=[False, True])
+    sim_from = sim_df_sorted["item_idx_from"].to_numpy().astype(np.int32)
+    sim_neighbors = sim_df_sorted["item_idx_to"].to_numpy().astype(np.int32)
+    sim_scores = quantize_scores(sim_df_sorted["similarity"].to_numpy())
+    counts = np.bincount(sim_from, minlength=num_items)
+    sim_indptr = np.concatenate([[0], np.cumsum(counts)]).astype(np.int32)
+
+    return {
+        "sim_indptr": sim_indptr,
+        "sim_neighbors": sim_neighbors,
+        "sim_scores": sim_scores,
+        "genre_names": np.array(genre_names, dtype=np.str_),
+        "genre_indptr": genre_indptr,
+        "genre_items": genre_items,
+        "movie_ids": movie_ids,
+        "title_offsets": title_offsets,
+        "title_bytes": title_bytes,
+    }
+
+
+def empty_reco_arrays() -> Dict[str, np.ndarray]:
+    """Returns empty arrays with the artifact layout, used when loading fails."""
+    return {
+        "sim_indptr": np.zeros(1, dtype=np.int32),
+        "sim_neighbors": np.zeros(0, dtype=np.int32),
+        "sim_scores": np.zeros(0, dtype=np.int16),
+        "genre_names": np.zeros(0, dtype=np.str_),
+        "genre_indptr": np.zeros(1, dtype=np.int32),
+        "genre_items": np.zeros(0, dtype=np.int32),
+        "movie_ids": np.zeros(0, dtype=np.int64),
+        "title_offsets": np.zeros(1, dtype=np.int64),
+        "title_bytes": np.zeros(0, dtype=np.uint8),
+    }
+
+
+def save_reco_arrays(arrays: Dict[str, np.ndarray], output_dir: Path):
+    """Writes each array to <output_dir>/<name>.npy."""
+    output_dir.mkdir(parents=True, exist_ok=True)
+    for name in ARRAY_NAMES:
+        np.save(output_dir / f"{name}.npy", arrays[name])
+    logger.info(f"Saved {len(ARRAY_NAMES)} recommendation arrays to {output_dir}.")
+
+
+def load_reco_arrays(input_dir: Path) -> Dict[str, np.ndarray]:
+    """
+    Memory-maps the arrays written by save_reco_arrays (read-only), so worker
+    processes share the same physical pages instead of each holding a copy.
+    """
+    return {name: np.load(input_dir / f"{name}.npy", mmap_mode="r") for name in ARRAY_NAMES}
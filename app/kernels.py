@@ -0,0 +1,64 @@
+# Numba min-heap helpers for bounded top-k selection, shared by app/recommend.py
+# (per-request aggregation) and scripts/03_compute_sim.py (cosine neighbours).
+# The heap is a pair of parallel arrays (item indices, scores) whose root holds the
+# weakest kept item. Defining jitted functions is cheap; they compile on first call.
+
+try:
+    from numba import njit
+    NUMBA_AVAILABLE = True
+except ImportError:
+    NUMBA_AVAILABLE = False
+
+
+if NUMBA_AVAILABLE:
+    @njit(cache=True, fastmath=True)
+    def heap_sift_down(heap_idx, heap_scr, size, pos):
+        """Restores the min-heap property below `pos`."""
+        while True:
+            smallest = pos
+            left = 2 * pos + 1
+            right = left + 1
+            if left < size and heap_scr[left] < heap_scr[smallest]:
+                smallest = left
+            if right < size and heap_scr[right] < heap_scr[smallest]:
+                smallest = right
+            if smallest == pos:
+                return
+            heap_idx[pos], heap_idx[smallest] = heap_idx[smallest], heap_idx[pos]
+            heap_scr[pos], heap_scr[smallest] = heap_scr[smallest], heap_scr[pos]
+            pos = smallest
+
+    @njit(cache=True, fastmath=True)
+    def heap_push(heap_idx, heap_scr, size, item, score):
+        """
+        Offers (item, score) to a heap holding `size` entries with capacity
+        len(heap_idx). Appends while there is room, otherwise replaces the root
+        if the score beats it. Returns the new size.
+        """
+        if size < heap_idx.size:
+            pos = size
+            heap_idx[pos] = item
+            heap_scr[pos] = score
+            while pos > 0:
+                parent = (pos - 1) // 2
+                if heap_scr[parent] <= heap_scr[pos]:
+                    break
+                heap_idx[pos], heap_idx[parent] = heap_idx[parent], heap_idx[pos]
+                heap_scr[pos], heap_scr[parent] = heap_scr[parent], heap_scr[pos]
+                pos = parent
+            return size + 1
+        if score > heap_scr[0]:
+            heap_idx[0] = item
+            heap_scr[0] = score
+            heap_sift_down(heap_idx, heap_scr, size, 0)
+        return size
+
+    @njit(cache=True, fastmath=True)
+    def heap_pop_sorted(heap_idx, heap_scr, size, out_idx, out_scr):
+        """Empties the heap into out_idx/out_scr[:size], ordered best first."""
+        for k in range(size - 1, -1, -1):
+            out_idx[k] = heap_idx[0]
+            out_scr[k] = heap_scr[0]
+            heap_idx[0] = heap_idx[k]
+            heap_scr[0] = heap_scr[k]
+            heap_sift_down(heap_idx, heap_scr, k, 0)
@@ -1,87 +1,191 @@
 import polars as pl
 import numpy as np
 from pathlib import Path
+from functools import lru_cache
 from typing import List, Dict, Tuple, Set
-import random
-import logging
+import os
+import threading
+from .artifacts import build_reco_arrays, empty_reco_arrays, load_reco_arrays
+from .kernels import NUMBA_AVAILABLE
 from .utils import get_logger
 
+if NUMBA_AVAILABLE:
+    from numba import njit
+    from .kernels import heap_pop_sorted, heap_push
+
 logger = get_logger(__name__)
 
 # --- Configuration ---
 MODEL_DIR = Path("app/models")
+RECO_ARRAYS_DIR = MODEL_DIR / "reco" # Prebuilt by scripts/03_compute_sim.py
 SIMILARITY_FILE = MODEL_DIR / "sim.parquet"
 GENRE_MAP_FILE = MODEL_DIR / "genre_map.parquet"
 TOP_K_SIMILAR = 50 # Must match the K used in 03_compute_sim.py
 RECOMMENDATION_COUNT = 20 # Default number of recommendations to return
+RECOMMENDATION_CACHE_SIZE = 8192 # Distinct histories whose top-N indices are cached
 
 # --- Load Data ---
 try:
-    logger.info(f"Loading similarity data from {SIMILARITY_FILE}...")
-    sim_df = pl.read_parquet(SIMILARITY_FILE)
-    logger.info("Similarity data loaded.")
-
-    logger.info(f"Loading genre map from {GENRE_MAP_FILE}...")
-    genre_map_df = pl.read_parquet(GENRE_MAP_FILE)
-    logger.info("Genre map loaded.")
-
-    # --- Precompute Lookups for Efficiency ---
-    logger.info("Preprocessing data for faster lookups...")
-
-    # 1. Movie ID to internal index mapping (and vice-versa)
-    movie_id_to_idx = dict(zip(genre_map_df['movieId'], genre_map_df['item_idx']))
-    idx_to_movie_id = dict(zip(genre_map_df['item_idx'], genre_map_df['movieId']))
-    idx_to_title = dict(zip(genre_map_df['item_idx'], genre_map_df['title']))
-
-    # 2. Genre to list of item indices mapping
-    genre_to_indices: Dict[str, List[int]] = {}
-    all_genres: Set[str] = set()
-    for row in genre_map_df.iter_rows(named=True):
-        genres = row['genres'].split('|')
-        item_idx = row['item_idx']
-        for genre in genres:
-            if genre == "(no genres listed)": continue # Skip this category
-            all_genres.add(genre)
-            if genre not in genre_to_indices:
-                genre_to_indices[genre] = []
-            genre_to_indices[genre].append(item_idx)
-
-    # 3. Similarity lookup (item_idx_from -> List[(item_idx_to, similarity)])
-    # Group by 'item_idx_from' and aggregate 'item_idx_to' and 'similarity'
-    similarity_lookup: Dict[int, List[Tuple[int, float]]] = {}
-    # Sort by similarity descending within each group for faster top-k retrieval later
-    sim_df_sorted = sim_df.sort("item_idx_from", "similarity", descending=[False, True])
-    for group_key, group_df in sim_df_sorted.group_by("item_idx_from"):
-         # group_key is a tuple, take the first element
-        from_idx = group_key[0]
-        # Convert group to list of tuples
-        similar_items = list(zip(group_df['item_idx_to'], group_df['similarity']))
-        similarity_lookup[from_idx] = similar_items
-
-    logger.info("Preprocessing finished.")
+    if RECO_ARRAYS_DIR.exists():
+        logger.info(f"Loading prebuilt recommendation arrays from {RECO_ARRAYS_DIR}...")
+        arrays = load_reco_arrays(RECO_ARRAYS_DIR)
+    else:
+        # Older model directories only ship the parquet files: build the arrays in-process
+        logger.warning(f"{RECO_ARRAYS_DIR} not found. Building recommendation arrays from parquet files "
+                       "(run scripts/03_compute_sim.py to prebuild them).")
+        logger.info(f"Loading similarity data from {SIMILARITY_FILE}...")
+        sim_df = pl.read_parquet(SIMILARITY_FILE)
+        logger.info(f"Loading genre map from {GENRE_MAP_FILE}...")
+        genre_map_df = pl.read_parquet(GENRE_MAP_FILE)
+        arrays = build_reco_arrays(sim_df, genre_map_df)
+        del sim_df, genre_map_df
+    logger.info("Recommendation arrays loaded.")
 
 except FileNotFoundError as e:
-    logger.error(f"Model file not found: {e}. Ensure sim.parquet and genre_map.parquet are in app/models/")
-    # Set data to None or empty structures to indicate failure
-    sim_df = None
-    genre_map_df = None
-    movie_id_to_idx = {}
-    idx_to_movie_id = {}
-    idx_to_title = {}
-    genre_to_indices = {}
-    all_genres = set()
-    similarity_lookup = {}
+    logger.error(f"Model file not found: {e}. Ensure the reco/ arrays or sim.parquet and genre_map.parquet are in app/models/")
+    # Fall back to empty structures to indicate failure
+    arrays = empty_reco_arrays()
 except Exception as e:
     logger.error(f"An error occurred during model loading or preprocessing: {e}")
-    # Set data to None or empty structures
-    sim_df = None
-    genre_map_df = None
-    movie_id_to_idx = {}
-    idx_to_movie_id = {}
-    idx_to_title = {}
-    genre_to_indices = {}
-    all_genres = set()
-    similarity_lookup = {}
+    arrays = empty_reco_arrays()
+
+# --- Bind Lookups ---
+# Similarity lookup in CSR layout over items:
+# neighbours of item i are sim_neighbors[sim_indptr[i]:sim_indptr[i + 1]]
+sim_indptr = arrays["sim_indptr"]
+sim_neighbors = arrays["sim_neighbors"]
+sim_scores = arrays["sim_scores"]
+
+# Genre to item indices: items of genre g are genre_items[genre_indptr[g]:genre_indptr[g + 1]]
+genre_indptr = arrays["genre_indptr"]
+genre_items = arrays["genre_items"]
+genre_to_id: Dict[str, int] = {genre: i for i, genre in enumerate(arrays["genre_names"].tolist())}
+all_genres: Set[str] = set(genre_to_id)
+
+# Internal index to movie ID / title, and movie ID to internal index
+movie_ids = arrays["movie_ids"]
+title_offsets = arrays["title_offsets"]
+title_bytes = arrays["title_bytes"]
+num_items = movie_ids.size
+movie_id_to_idx: Dict[int, int] = {mid: idx for idx, mid in enumerate(movie_ids.tolist()) if mid >= 0}
+del arrays
+
+# Shared random generator for random_by_genre
+rng = np.random.default_rng()
+
+def _reseed_rng():
+    """Gives each forked worker (Gunicorn preload_app) its own random stream."""
+    global rng
+    rng = np.random.default_rng()
+
+os.register_at_fork(after_in_child=_reseed_rng)
+
+# --- Top-K Aggregation Kernels ---
+
+# Per-thread dense score accumulator reused across requests (endpoints run in a thread pool)
+_scratch = threading.local()
+
+def _get_scratch_scores(size: int) -> np.ndarray:
+    """Returns this thread's zeroed accumulator with at least `size` entries."""
+    scores = getattr(_scratch, "scores", None)
+    if scores is None or scores.size < size:
+        scores = np.zeros(size, dtype=np.int32)
+        _scratch.scores = scores
+    return scores
+
+def _agg_topk_numpy(indptr: np.ndarray, neighbors: np.ndarray, scores: np.ndarray,
+                    history: np.ndarray, n: int) -> np.ndarray:
+    """
+    Sums the neighbour scores of the history items and returns the indices of
+    the N best candidates (excluding history items), best first.
+    """
+    # Gather the precomputed neighbour slices of every history item
+    all_neighbors = np.concatenate([neighbors[indptr[i]:indptr[i + 1]] for i in history])
+    all_scores = np.concatenate([scores[indptr[i]:indptr[i + 1]] for i in history])
+    if not all_neighbors.size or n <= 0:
+        return np.zeros(0, dtype=np.int32)
+
+    # Aggregate scores per candidate item in the reused accumulator,
+    # then reset only the positions written instead of the whole array
+    accumulator = _get_scratch_scores(max(indptr.size - 1, int(all_neighbors.max()) + 1))
+    try:
+        np.add.at(accumulator, all_neighbors, all_scores)
+        candidates = np.unique(all_neighbors)
+        candidate_scores = accumulator[candidates]
+    finally:
+        accumulator[all_neighbors] = 0
+
+    # Ignore items already in the user's history and keep only positive scores
+    keep = (candidate_scores > 0) & ~np.isin(candidates, history)
+    candidates, candidate_scores = candidates[keep], candidate_scores[keep]
+
+    # Select the top N candidates
+    n = min(n, candidates.size)
+    if n <= 0:
+        return np.zeros(0, dtype=np.int32)
+    top = np.argpartition(-candidate_scores, n - 1)[:n]
+    top = top[np.argsort(-candidate_scores[top], kind="stable")]
+    return candidates[top]
+
+
+if NUMBA_AVAILABLE:
+    @njit(cache=True, fastmath=True)
+    def _agg_topk(indptr, neighbors, scores, history, n):
+        """
+        Same contract as _agg_topk_numpy, but aggregates into a small
+        open-addressed hash map sized to the number of gathered neighbours
+        (instead of a dense array over the whole catalogue) and selects the
+        top N with a bounded min-heap.
+        """
+        if n <= 0:
+            return np.zeros(0, dtype=np.int32)
+
+        total = 0
+        for h in history:
+            total += indptr[h + 1] - indptr[h]
+        capacity = 16
+        while capacity < 2 * total:
+            capacity <<= 1
+        mask = capacity - 1
+
+        # Linear-probed item -> aggregated score map (int32 sums of int16 scores)
+        keys = np.full(capacity, -1, dtype=np.int32)
+        vals = np.zeros(capacity, dtype=np.int32)
+        for h in history:
+            for j in range(indptr[h], indptr[h + 1]):
+                item = neighbors[j]
+                slot = (np.int64(item) * 2654435761) & mask
+                while keys[slot] != -1 and keys[slot] != item:
+                    slot = (slot + 1) & mask
+                keys[slot] = item
+                vals[slot] += scores[j]
+
+        # Keep the N best candidates in a min-heap (root = weakest kept item)
+        heap_idx = np.empty(n, dtype=np.int32)
+        heap_scr = np.empty(n, dtype=np.int32)
+        size = 0
+        for slot in range(capacity):
+            item = keys[slot]
+            score = vals[slot]
+            if item == -1 or score <= 0:
+                continue
+            in_history = False
+            for h in history:
+                if h == item:
+                    in_history = True
+                    break
+            if in_history:
+                continue
+            size = heap_push(heap_idx, heap_scr, size, item, score)
+
+        # Pop the heap so the result is ordered best first
+        result = np.empty(size, dtype=np.int32)
+        result_scr = np.empty(size, dtype=np.int32)
+        heap_pop_sorted(heap_idx, heap_scr, size, result, result_scr)
+        return result
+else:
+    logger.warning("Numba not installed. Falling back to the NumPy recommendation kernel.")
+    _agg_topk = _agg_topk_numpy
 
 # --- Recommendation Functions ---
 
@@ -91,46 +195,61 @@ def get_all_genres() -> List[str]:
         logger.warning("Genre list is empty. Models might not have loaded correctly.")
     return sorted(list(all_genres))
 
-def _get_movie_details(item_indices: List[int]) -> List[Dict]:
+def _get_movie_details(item_indices: np.ndarray) -> List[Dict]:
     """Helper to get movie details (id, title) from internal indices."""
-    details = []
-    for idx in item_indices:
-        movie_id = idx_to_movie_id.get(idx)
-        title = idx_to_title.get(idx)
-        if movie_id and title:
-            details.append({"movieId": movie_id, "title": title})
-        else:
-             logger.warning(f"Could not find details for item index: {idx}")
-    return details
+    indices = np.asarray(item_indices, dtype=np.int64)
+    in_range = (indices >= 0) & (indices < num_items)
+    safe_indices = np.where(in_range, indices, 0)
+
+    # Gather ids and title spans for all indices at once
+    ids = np.where(in_range, movie_ids[safe_indices], -1)
+    starts = title_offsets[safe_indices]
+    ends = title_offsets[safe_indices + 1]
+    found = (ids >= 0) & (ends > starts)
+    if not found.all():
+        logger.warning(f"Could not find details for item indices: {indices[~found].tolist()}")
+
+    return [
+        {"movieId": movie_id, "title": title_bytes[start:end].tobytes().decode("utf-8")}
+        for movie_id, start, end in zip(ids[found].tolist(), starts[found].tolist(), ends[found].tolist())
+    ]
 
 
 def random_by_genre(genre: str, n: int = RECOMMENDATION_COUNT) -> List[Dict]:
     """Returns N random movies from the specified genre."""
-    if not genre_to_indices:
+    if not genre_to_id:
          logger.error("Genre to indices mapping not available. Cannot provide random recommendations.")
          return []
-    if genre not in genre_to_indices:
+    if genre not in genre_to_id:
         logger.warning(f"Genre '{genre}' not found.")
         return []
 
-    indices_in_genre = genre_to_indices[genre]
-    if len(indices_in_genre) <= n:
-        # If fewer movies than requested, return all of them shuffled
-        random.shuffle(indices_in_genre)
-        selected_indices = indices_in_genre
-    else:
-        selected_indices = random.sample(indices_in_genre, n)
+    g = genre_to_id[genre]
+    pool = genre_items[genre_indptr[g]:genre_indptr[g + 1]]
+    # Sampling without replacement returns the whole pool shuffled when it has fewer than N movies
+    selected_indices = rng.choice(pool, size=min(n, pool.size), replace=False)
 
     logger.info(f"Returning {len(selected_indices)} random movies for genre '{genre}'.")
     return _get_movie_details(selected_indices)
 
 
+@lru_cache(maxsize=RECOMMENDATION_CACHE_SIZE)
+def _topk_cached(history_indices: Tuple[int, ...], n: int) -> Tuple[int, ...]:
+    """
+    Returns the top-N item indices for a (sorted) history of item indices.
+    The models are immutable at runtime, so results never need invalidating
+    unless the arrays are reloaded (call _topk_cached.cache_clear() then).
+    """
+    history = np.asarray(history_indices, dtype=np.int32)
+    return tuple(_agg_topk(sim_indptr, sim_neighbors, sim_scores, history, n).tolist())
+
+
 def recommend_top_k(history_movie_ids: List[int], n: int = RECOMMENDATION_COUNT) -> List[Dict]:
     """
     Recommends N movies based on the user's recent history (list of movie IDs).
     Uses item-to-item similarity.
     """
-    if not similarity_lookup or not movie_id_to_idx:
+    if not sim_neighbors.size or not movie_id_to_idx:
         logger.error("Similarity lookup or ID mapping not available. Cannot provide recommendations.")
         return []
     if not history_movie_ids:
@@ -143,28 +262,10 @@ def recommend_top_k(history_movie_ids: List[int], n: int = RECOMMENDATION_COUNT)
         logger.warning(f"None of the history movie IDs {history_movie_ids} found in the model.")
         return []
 
-    # Aggregate similar items based on history
-    candidate_scores: Dict[int, float] = {}
-    history_set = set(history_indices) # For quick filtering later
-
     logger.debug(f"Generating recommendations based on history indices: {history_indices}")
 
-    # Iterate through each item in the user's history
-    for idx_from in history_indices:
-        # Get precomputed similar items for this history item
-        similar_items = similarity_lookup.get(idx_from, [])
-
-        # Add scores of similar items to candidates
-        for idx_to, score in similar_items:
-            # Ignore items already in the user's history
-            if idx_to not in history_set:
-                candidate_scores[idx_to] = candidate_scores.get(idx_to, 0.0) + score
-
-    # Sort candidates by aggregated score (descending)
-    sorted_candidates = sorted(candidate_scores.items(), key=lambda item: item[1], reverse=True)
-
-    # Get top N recommendations
-    recommended_indices = [idx for idx, score in sorted_candidates[:n]]
+    # The aggregation is a sum, so the history order does not matter for the cache key
+    recommended_indices = _topk_cached(tuple(sorted(history_indices)), n)
 
     logger.info(f"Returning {len(recommended_indices)} recommendations based on history {history_movie_ids}.")
     return _get_movie_details(recommended_indices)
@@ -1,7 +1,7 @@
 import redis
 import json
 import os
-from typing import List, Optional
+from typing import List, Optional, Tuple
 import logging
 from .utils import get_logger
 
@@ -15,7 +15,9 @@ REDIS_PASSWORD = os.getenv("REDIS_PASSWORD", None)
 REDIS_DB = int(os.getenv("REDIS_DB", 0))
 
 SESSION_PREFIX = "session:"
+RANDOM_SAMPLE_PREFIX = "random:" # Current /random response body per genre, shared by all workers
 MAX_HISTORY_LENGTH = 5 # Keep track of the last 5 movie choices
+SESSION_TTL = int(os.getenv("SESSION_TTL", 60 * 60 * 24)) # Seconds before an idle session expires
 
 # --- Initialize Redis Client ---
 try:
@@ -65,6 +67,7 @@ def push_choice(session_id: str, movie_id: int):
     """
     Adds a movie choice to the session's history and trims the history
     to the maximum allowed length (MAX_HISTORY_LENGTH).
+    All commands are sent in a single round-trip and refresh the session expiry.
     """
     if not redis_client:
         logger.warning("Redis client not available. Cannot push choice to session.")
@@ -72,14 +75,46 @@ def push_choice(session_id: str, movie_id: int):
 
     key = _get_session_key(session_id)
     try:
-        # Add the new movie ID to the beginning of the list
-        redis_client.lpush(key, str(movie_id))
-        # Trim the list to keep only the most recent MAX_HISTORY_LENGTH items
-        redis_client.ltrim(key, 0, MAX_HISTORY_LENGTH - 1)
+        with redis_client.pipeline(transaction=False) as pipe:
+            # Add the new movie ID to the beginning of the list
+            pipe.lpush(key, str(movie_id))
+            # Trim the list to keep only the most recent MAX_HISTORY_LENGTH items
+            pipe.ltrim(key, 0, MAX_HISTORY_LENGTH - 1)
+            # Retire idle sessions
+            pipe.expire(key, SESSION_TTL)
+            pipe.execute()
         logger.debug(f"Pushed movie ID {movie_id} to session {session_id}. History trimmed.")
     except redis.exceptions.RedisError as e:
         logger.error(f"Redis error pushing choice for session {session_id}: {e}")
 
+def push_and_get(session_id: str, movie_id: int) -> List[int]:
+    """
+    Adds a movie choice to the session's history (like push_choice) and returns
+    the updated history (like get_mem), using a single Redis round-trip.
+    Returns an empty list if Redis is unavailable.
+    """
+    if not redis_client:
+        logger.warning("Redis client not available. Cannot update session memory.")
+        return []
+
+    key = _get_session_key(session_id)
+    try:
+        with redis_client.pipeline(transaction=False) as pipe:
+            pipe.lpush(key, str(movie_id))
+            pipe.ltrim(key, 0, MAX_HISTORY_LENGTH - 1)
+            pipe.lrange(key, 0, -1)
+            pipe.expire(key, SESSION_TTL)
+            history_str = pipe.execute()[2]
+        history_int = [int(mid) for mid in history_str]
+        logger.debug(f"Pushed movie ID {movie_id} to session {session_id}. History: {history_int}")
+        return history_int
+    except redis.exceptions.RedisError as e:
+        logger.error(f"Redis error updating history for session {session_id}: {e}")
+        return []
+    except ValueError as e:
+        logger.error(f"Error converting history item to int for session {session_id}: {e}")
+        return []
+
 def clear_session(session_id: str):
     """Clears the history for a given session."""
     if not redis_client:
@@ -92,3 +127,27 @@ def clear_session(session_id: str):
         logger.info(f"Cleared history for session {session_id}.")
     except redis.exceptions.RedisError as e:
         logger.error(f"Redis error clearing session {session_id}: {e}")
+
+def share_random_sample(genre: str, body: bytes, ttl: int) -> Tuple[bytes, float]:
+    """
+    Publishes a /random response body for a genre unless another worker already
+    stored one that hasn't expired. Returns the body all workers should serve and
+    its remaining lifetime in seconds, in a single Redis round-trip.
+    Returns the given body and ttl unchanged if Redis is unavailable.
+    """
+    if not redis_client:
+        return body, float(ttl)
+
+    key = f"{RANDOM_SAMPLE_PREFIX}{genre}"
+    try:
+        with redis_client.pipeline(transaction=True) as pipe:
+            pipe.set(key, body.decode("utf-8"), nx=True, ex=ttl)
+            pipe.get(key)
+            pipe.pttl(key)
+            _, shared_body, remaining_ms = pipe.execute()
+        if shared_body is None or remaining_ms <= 0:
+            return body, float(ttl)
+        return shared_body.encode("utf-8"), remaining_ms / 1000
+    except redis.exceptions.RedisError as e:
+        logger.error(f"Redis error sharing random sample for genre {genre}: {e}")
+        return body, float(ttl)
@@ -0,0 +1,19 @@
+# Gunicorn configuration for the FastAPI backend (used by the Dockerfile CMD).
+# Run locally with: gunicorn -c gunicorn.conf.py app.main:app
+
+import multiprocessing
+import os
+
+bind = f"0.0.0.0:{os.getenv('API_PORT', 8000)}"
+
+# Several worker processes so recommendation scoring can use every CPU core.
+# Override with WEB_CONCURRENCY (e.g. when running next to other services).
+workers = int(os.getenv("WEB_CONCURRENCY", multiprocessing.cpu_count() * 2 + 1))
+
+# Each worker runs its own Uvicorn event loop; uvicorn[standard] installs
+# uvloop and httptools, which Uvicorn picks automatically over asyncio/h11.
+worker_class = "uvicorn_worker.UvicornWorker"
+
+# Import the app (and its model arrays) once in the master process so the
+# forked workers share those pages copy-on-write instead of each loading them.
+preload_app = True
@@ -1,7 +1,9 @@
 import os
+import shutil
 import requests
 import zipfile
 from tqdm import tqdm
+from tqdm.utils import CallbackIOWrapper
 import logging
 
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
@@ -24,8 +26,10 @@ if not os.path.exists(ZIP_FILE_PATH):
         response.raise_for_status() # Raise an exception for bad status codes
 
         total_size = int(response.headers.get('content-length', 0))
-        block_size = 1024 # 1 Kibibyte
+        block_size = 1024 * 1024 # 1 Mebibyte
 
+        # Let urllib3 undo any transfer encoding while we read the raw stream
+        response.raw.decode_content = True
         with open(ZIP_FILE_PATH, 'wb') as file, tqdm(
             desc=os.path.basename(ZIP_FILE_PATH),
             total=total_size,
@@ -33,9 +37,8 @@ if not os.path.exists(ZIP_FILE_PATH):
             unit_scale=True,
             unit_divisor=1024,
         ) as bar:
-            for data in response.iter_content(block_size):
-                bar.update(len(data))
-                file.write(data)
+            # Copy in large blocks inside shutil; the wrapper reports each read to the progress bar
+            shutil.copyfileobj(CallbackIOWrapper(bar.update, response.raw, "read"), file, length=block_size)
 
         if total_size != 0 and bar.n != total_size:
             logging.error("ERROR, something went wrong during download")
@@ -55,11 +58,16 @@ if not os.path.exists(EXTRACTED_DATA_PATH):
     logging.info(f"Extracting {ZIP_FILE_PATH} to {RAW_DATA_DIR}...")
     try:
         with zipfile.ZipFile(ZIP_FILE_PATH, 'r') as zip_ref:
-            # Get list of files in zip
+            # Get list of files in zip and refuse members that would land outside RAW_DATA_DIR
             file_list = zip_ref.namelist()
-            # Extract files with progress
-            for file in tqdm(iterable=file_list, total=len(file_list), desc="Extracting files"):
-                zip_ref.extract(member=file, path=RAW_DATA_DIR)
+            raw_root = os.path.realpath(RAW_DATA_DIR)
+            for file in file_list:
+                target = os.path.realpath(os.path.join(RAW_DATA_DIR, file))
+                if os.path.commonpath([raw_root, target]) != raw_root:
+                    raise ValueError(f"Unsafe path in archive: {file}")
+            # Extract everything in one call (zipfile streams each member to disk in C-sized chunks)
+            logging.info(f"Extracting {len(file_list)} files...")
+            zip_ref.extractall(path=RAW_DATA_DIR)
         logging.info("Extraction complete.")
     except zipfile.BadZipFile:
         logging.error(f"Error: The downloaded file {ZIP_FILE_PATH} is not a valid zip file or is corrupted.")
@@ -14,6 +14,8 @@ RATINGS_FILE = RAW_DATA_DIR / "ratings.csv"
 MOVIES_FILE = RAW_DATA_DIR / "movies.csv"
 OUTPUT_MATRIX_FILE = PROCESSED_DATA_DIR / "user_item.npz"
 OUTPUT_GENRE_MAP_FILE = PROCESSED_DATA_DIR / "genre_map.parquet"
+OUTPUT_USER_MAP_FILE = PROCESSED_DATA_DIR / "user_map.parquet" # user_idx -> userId, reused by 04_evaluate.py
+OUTPUT_ITEM_MAP_FILE = PROCESSED_DATA_DIR / "item_map.parquet" # item_idx -> movieId, reused by 04_evaluate.py
 RATING_THRESHOLD = 3.5 # Threshold to consider a rating as a positive interaction
 
 # --- Ensure directories exist ---
@@ -25,41 +27,34 @@ if not RATINGS_FILE.exists() or not MOVIES_FILE.exists():
     exit(1)
 
 # --- Load and process ratings ---
-logging.info(f"Loading ratings from {RATINGS_FILE}...")
+logging.info(f"Scanning ratings from {RATINGS_FILE}...")
 try:
-    # Load all ratings for the final run
-    ratings_df = pl.read_csv(RATINGS_FILE)
-    logging.info(f"Loaded {len(ratings_df)} ratings.")
-
-    # Filter ratings above threshold and create implicit feedback
+    # Lazy scan: Polars only parses the needed columns and applies the threshold while reading
     logging.info(f"Filtering ratings >= {RATING_THRESHOLD} and creating implicit feedback...")
-    implicit_df = ratings_df.filter(pl.col("rating") >= RATING_THRESHOLD)
-    logging.info(f"Found {len(implicit_df)} positive interactions.")
-
-    # Create unique user and item IDs (contiguous integers starting from 0)
+    # Map original IDs to contiguous integers starting from 0. A dense rank over the IDs
+    # gives the same sorted order as enumerating the sorted unique IDs, without a Python dict.
     logging.info("Mapping user and movie IDs to contiguous integers...")
-    unique_users = implicit_df["userId"].unique().sort()
-    unique_movies = implicit_df["movieId"].unique().sort()
-
-    user_map = {user_id: i for i, user_id in enumerate(unique_users)}
-    movie_map = {movie_id: i for i, movie_id in enumerate(unique_movies)}
-    # Create reverse map for later use if needed (e.g., evaluation)
-    # movie_reverse_map = {i: movie_id for movie_id, i in movie_map.items()}
-
-    # Map original IDs to new contiguous IDs using replace
-    implicit_df = implicit_df.with_columns([
-        pl.col("userId").replace(user_map).alias("user_idx"),
-        pl.col("movieId").replace(movie_map).alias("item_idx")
-    ])
+    implicit_df = (
+        pl.scan_csv(RATINGS_FILE)
+        .select(["userId", "movieId", "rating"])
+        .filter(pl.col("rating") >= RATING_THRESHOLD)
+        .with_columns([
+            # Int32 indices (as implicit's C++ backend expects) so to_numpy() needs no extra cast
+            (pl.col("userId").rank("dense") - 1).cast(pl.Int32).alias("user_idx"),
+            (pl.col("movieId").rank("dense") - 1).cast(pl.Int32).alias("item_idx"),
+        ])
+        .collect()
+    )
+    logging.info(f"Found {len(implicit_df)} positive interactions.")
 
     # --- Build sparse matrix ---
     logging.info("Building user-item sparse matrix (CSR format)...")
-    num_users = len(unique_users)
-    num_items = len(unique_movies)
+    num_users = int(implicit_df["user_idx"].max()) + 1
+    num_items = int(implicit_df["item_idx"].max()) + 1
     # Use mapped indices and set data to 1 for implicit feedback
-    # Explicitly cast indices to int32 to avoid dtype mismatch issues with implicit's C++ backend
-    user_indices = implicit_df["user_idx"].to_numpy().astype(np.int32)
-    item_indices = implicit_df["item_idx"].to_numpy().astype(np.int32)
+    # Indices are already int32 (cast in the Polars query), so these are zero-copy views
+    user_indices = implicit_df["user_idx"].to_numpy()
+    item_indices = implicit_df["item_idx"].to_numpy()
     data = np.ones(len(implicit_df), dtype=np.float32) # Implicit feedback is 1
 
     user_item_matrix = csr_matrix((data, (user_indices, item_indices)), shape=(num_users, num_items))
@@ -69,21 +64,26 @@ try:
     save_npz(OUTPUT_MATRIX_FILE, user_item_matrix)
     logging.info(f"Matrix saved. Shape: {user_item_matrix.shape}, Non-zero elements: {user_item_matrix.nnz}")
 
+    # --- Save the ID maps ---
+    logging.info(f"Saving ID maps to {OUTPUT_USER_MAP_FILE} and {OUTPUT_ITEM_MAP_FILE}...")
+    implicit_df.select("user_idx", "userId").unique().sort("user_idx").write_parquet(OUTPUT_USER_MAP_FILE)
+    implicit_df.select("item_idx", "movieId").unique().sort("item_idx").write_parquet(OUTPUT_ITEM_MAP_FILE)
+    logging.info("ID maps saved.")
+
     # --- Create and save genre map ---
     logging.info(f"Loading movies from {MOVIES_FILE} to create genre map...")
-    movies_df = pl.read_csv(MOVIES_FILE)
-
-    # Filter movies that are actually present in the interaction matrix
-    movies_in_matrix = pl.DataFrame({"movieId": list(movie_map.keys())})
-    movies_df = movies_df.join(movies_in_matrix, on="movieId", how="inner")
-
-    # Map original movie IDs to the new contiguous item indices using replace
-    movies_df = movies_df.with_columns(
-        pl.col("movieId").replace(movie_map).alias("item_idx")
+    # Keep only movies present in the interaction matrix and attach their item indices.
+    # The join against the narrow (movieId, item_idx) frame filters and maps in one hash probe
+    # (a semi-join would need a second join for item_idx), and the scan and join run as one query.
+    movie_map = implicit_df.select("movieId", pl.col("item_idx").cast(pl.Int64)).unique()
+    genre_map_df = (
+        pl.scan_csv(MOVIES_FILE)
+        .join(movie_map.lazy(), on="movieId", how="inner")
+        .select(["movieId", "item_idx", "title", "genres"])
+        .collect()
     )
 
-    # Select relevant columns and save
-    genre_map_df = movies_df.select(["movieId", "item_idx", "title", "genres"])
+    # Save the genre map
     logging.info(f"Saving genre map to {OUTPUT_GENRE_MAP_FILE}...")
     genre_map_df.write_parquet(OUTPUT_GENRE_MAP_FILE)
     logging.info("Genre map saved.")
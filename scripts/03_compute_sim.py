@@ -1,20 +1,35 @@
 import os
+import sys
 import numpy as np
 import polars as pl
-from scipy.sparse import load_npz, csr_matrix
+from scipy.sparse import load_npz, save_npz, csr_matrix
 import implicit.nearest_neighbours
 import logging
 from pathlib import Path
 import time
-import torch # To check for CUDA availability
 from tqdm import tqdm # Import tqdm for progress bar
 
+try:
+    from numba import njit, prange, get_num_threads
+    NUMBA_AVAILABLE = True
+except ImportError:
+    NUMBA_AVAILABLE = False
+
+# Make the app package importable when running this script from the project root
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+from app.artifacts import build_reco_arrays, quantize_scores, save_reco_arrays
+if NUMBA_AVAILABLE:
+    from app.kernels import heap_pop_sorted, heap_push
+
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 
 # --- Configuration ---
 PROCESSED_DATA_DIR = Path("data/processed")
 INPUT_MATRIX_FILE = PROCESSED_DATA_DIR / "user_item.npz"
+INPUT_GENRE_MAP_FILE = PROCESSED_DATA_DIR / "genre_map.parquet"
 OUTPUT_SIMILARITY_FILE = PROCESSED_DATA_DIR / "sim.parquet"
+OUTPUT_SIMILARITY_MATRIX_FILE = PROCESSED_DATA_DIR / "sim.npz" # Same top-K similarities as int16 CSR, loaded by 04_evaluate.py
+OUTPUT_RECO_DIR = PROCESSED_DATA_DIR / "reco" # Serving arrays loaded by app/recommend.py
 TOP_K = 50 # Number of similar items to store for each item
 
 # --- Ensure directories exist ---
@@ -30,10 +45,10 @@ logging.info(f"Loading user-item matrix from {INPUT_MATRIX_FILE}...")
 try:
     user_item_matrix = load_npz(INPUT_MATRIX_FILE)
     logging.info(f"Matrix loaded. Shape: {user_item_matrix.shape}")
-    # Implicit library expects item-user matrix, so transpose it
-    item_user_matrix = user_item_matrix.T.tocsr()
-    logging.info(f"Transposed matrix to item-user format (CSR). Shape: {item_user_matrix.shape}")
-    # No need for explicit casting with the latest implicit version from source
+    # Since implicit 0.5, fit() takes the user-item matrix (rows are users) and computes
+    # similarities between its columns. Passing the transposed item-user matrix would
+    # compute user-user similarities and return user indices as "similar items".
+    user_item_matrix = user_item_matrix.tocsr()
 
 except FileNotFoundError:
     logging.error(f"Could not find input file: {INPUT_MATRIX_FILE}")
@@ -43,13 +58,82 @@ except Exception as e:
     exit(1)
 
 
-# --- Initialize the Cosine Recommender Model ---
-model = implicit.nearest_neighbours.CosineRecommender(K=TOP_K)
-
-# Check for GPU availability (still useful info)
-use_gpu = torch.cuda.is_available()
+# --- Numba cosine kernel ---
+if NUMBA_AVAILABLE:
+    @njit(parallel=True, cache=True, fastmath=True)
+    def _cosine_topk(item_indptr, item_users, item_weights, user_indptr, user_items, user_weights,
+                     k, num_chunks):
+        """
+        Top-k cosine neighbours (excluding the item itself) of every item, given the
+        L2-normalized matrix in both item-user and user-item CSR form. Items are split
+        into num_chunks strided chunks run in parallel, each with its own dense
+        accumulator, so the dot products of item i with every co-rated item are summed
+        by walking i's users and their items. Returns (num_items, k) indices and scores,
+        padded with -1 / 0 where an item has fewer than k neighbours.
+        """
+        num_items = len(item_indptr) - 1
+        out_idx = np.full((num_items, k), -1, dtype=np.int32)
+        out_scr = np.zeros((num_items, k), dtype=np.float32)
+        for c in prange(num_chunks):
+            acc = np.zeros(num_items, dtype=np.float64)
+            last_seen = np.full(num_items, -1, dtype=np.int64)
+            touched = np.empty(num_items, dtype=np.int32)
+            heap_idx = np.empty(k, dtype=np.int32)
+            heap_scr = np.empty(k, dtype=np.float64)
+            for i in range(c, num_items, num_chunks):
+                # Accumulate dot products with every item sharing a user with i
+                n_touched = 0
+                for p in range(item_indptr[i], item_indptr[i + 1]):
+                    u = item_users[p]
+                    w = item_weights[p]
+                    for q in range(user_indptr[u], user_indptr[u + 1]):
+                        j = user_items[q]
+                        if last_seen[j] != i:
+                            last_seen[j] = i
+                            acc[j] = 0.0
+                            touched[n_touched] = j
+                            n_touched += 1
+                        acc[j] += w * user_weights[q]
+
+                # Keep the k best in a min-heap (root = weakest kept item)
+                size = 0
+                for t in range(n_touched):
+                    j = touched[t]
+                    score = acc[j]
+                    if j == i or score <= 0.0:
+                        continue
+                    size = heap_push(heap_idx, heap_scr, size, j, score)
+
+                # Pop the heap so each row is ordered best first
+                heap_pop_sorted(heap_idx, heap_scr, size, out_idx[i], out_scr[i])
+        return out_idx, out_scr
+
+
+def cosine_topk(user_item_matrix, k):
+    """Top-k cosine similar items for every item, computed with the Numba kernel."""
+    item_user_matrix = user_item_matrix.T.tocsr().astype(np.float64)
+    # Normalize each item's vector, so cosine similarity is a plain dot product
+    row_ids = np.repeat(np.arange(item_user_matrix.shape[0]), np.diff(item_user_matrix.indptr))
+    norms = np.sqrt(np.bincount(row_ids, weights=item_user_matrix.data ** 2, minlength=item_user_matrix.shape[0]))
+    item_user_matrix.data /= norms[row_ids]
+    normalized_user_item = item_user_matrix.T.tocsr()
+    num_chunks = min(item_user_matrix.shape[0], 8 * get_num_threads()) # Small chunks balance uneven rows
+    return _cosine_topk(
+        item_user_matrix.indptr, item_user_matrix.indices, item_user_matrix.data,
+        normalized_user_item.indptr, normalized_user_item.indices, normalized_user_item.data,
+        k, max(num_chunks, 1)
+    )
+
+
+# Check for GPU availability (still useful info). implicit reports whether its CUDA
+# extension was built and found a device, without importing a GPU framework.
+try:
+    import implicit.gpu
+    use_gpu = implicit.gpu.HAS_CUDA
+except (ImportError, AttributeError):
+    use_gpu = False
 if use_gpu:
-    logging.info("CUDA is available. Attempting to use GPU for calculation.")
+    logging.info("CUDA is available, but item-item similarity has no GPU implementation. Using CPU for calculation.")
 else:
     logging.info("CUDA not available. Using CPU for calculation.")
 
@@ -57,62 +141,48 @@ else:
 logging.info(f"Calculating top-{TOP_K} similar items using Cosine Similarity...")
 start_time = time.time()
 try:
-    # Fit the model (should now handle int64 indices correctly)
-    logging.info("Calling model.fit...")
-    model.fit(item_user_matrix, show_progress=True)
-    logging.info("model.fit call completed.")
-
-    # Get similar items for all items using the trained model
-    # model.similar_items returns (indices, scores) for a given item_id or all items
-    # We want the full similarity matrix or top-K for all items.
-    # Let's get the top K for each item.
-    all_items = np.arange(item_user_matrix.shape[0])
-    similar_items_list = []
-    scores_list = []
-
-    # Iterate through items to get similarities (can be memory intensive for large K)
-    # A more direct way might exist depending on the implicit version,
-    # but this ensures we get the top K for each item.
-    # Alternatively, model.similarity matrix might be accessible if needed,
-    # but the plan asks for sim.parquet which implies a Top-K structure.
-
-    logging.info(f"Retrieving top-{TOP_K} similar items for each item...")
-    # Use recommend_all which is efficient for getting recommendations (similar items here)
-    # We need item indices, not user indices. Let's use similar_items batch processing if possible.
-    # The `similar_items` method can take an array of item IDs.
-    batch_size = 1024 # Process in batches to manage memory
-    num_items = item_user_matrix.shape[0]
-    all_similar_indices = np.zeros((num_items, TOP_K), dtype=np.int32)
-    all_similar_scores = np.zeros((num_items, TOP_K), dtype=np.float32)
-
-    for start_idx in tqdm(range(0, num_items, batch_size), desc="Finding similar items"):
-        end_idx = min(start_idx + batch_size, num_items)
-        item_ids_batch = np.arange(start_idx, end_idx)
-        # N=TOP_K+1 because the item itself is usually the most similar
-        # Removed filter_already_liked_items=False as it's not supported for item similarity
-        indices, scores = model.similar_items(item_ids_batch, N=TOP_K + 1, filter_items=None)
-
-        # Remove the item itself from the list (usually the first one with score 1.0)
-        # Check if the first item is the item itself
-        for i in range(len(item_ids_batch)):
-            original_item_idx = item_ids_batch[i]
-            if indices[i, 0] == original_item_idx:
-                all_similar_indices[original_item_idx] = indices[i, 1:]
-                all_similar_scores[original_item_idx] = scores[i, 1:]
-            else:
-                 # If the item itself wasn't the top match (unlikely with cosine), take top K
-                all_similar_indices[original_item_idx] = indices[i, :TOP_K]
-                all_similar_scores[original_item_idx] = scores[i, :TOP_K]
-
+    num_items = user_item_matrix.shape[1]
+    if NUMBA_AVAILABLE:
+        # One parallel pass over the CSR arrays, no per-batch Python glue
+        logging.info("Computing similarities with the Numba cosine kernel...")
+        all_similar_indices, all_similar_scores = cosine_topk(user_item_matrix, TOP_K)
+    else:
+        logging.info("Numba not installed. Falling back to implicit's CosineRecommender.")
+        # K counts the item itself, which is removed below, so keep one extra neighbour
+        model = implicit.nearest_neighbours.CosineRecommender(K=TOP_K + 1)
+        logging.info("Calling model.fit...")
+        model.fit(user_item_matrix, show_progress=True)
+        logging.info("model.fit call completed.")
+
+        # Get the top K similar items for every item, in batches of item IDs
+        logging.info(f"Retrieving top-{TOP_K} similar items for each item...")
+        batch_size = 1024 # Process in batches to manage memory
+        all_similar_indices = np.zeros((num_items, TOP_K), dtype=np.int32)
+        all_similar_scores = np.zeros((num_items, TOP_K), dtype=np.float32)
+
+        for start_idx in tqdm(range(0, num_items, batch_size), desc="Finding similar items"):
+            end_idx = min(start_idx + batch_size, num_items)
+            item_ids_batch = np.arange(start_idx, end_idx)
+            # N=TOP_K+1 because the item itself is usually the most similar
+            indices, scores = model.similar_items(item_ids_batch, N=TOP_K + 1, filter_items=None)
+
+            # Remove the item itself from each row (usually the first one with score 1.0).
+            # If the item wasn't among its own top matches (unlikely with cosine), drop the
+            # last column instead, so every row keeps exactly TOP_K entries.
+            keep_mask = indices != item_ids_batch[:, None]
+            keep_mask[keep_mask.all(axis=1), -1] = False
+            all_similar_indices[start_idx:end_idx] = indices[keep_mask].reshape(-1, TOP_K)
+            all_similar_scores[start_idx:end_idx] = scores[keep_mask].reshape(-1, TOP_K)
 
     end_time = time.time()
     logging.info(f"Similarity calculation finished in {end_time - start_time:.2f} seconds.")
 
     # --- Format results into a DataFrame ---
     logging.info("Formatting similarity results into a DataFrame...")
-    item_from_indices = np.repeat(np.arange(num_items), TOP_K)
-    item_to_indices = all_similar_indices.flatten()
-    similarity_scores = all_similar_scores.flatten()
+    # int32 indices throughout; the broadcast view is only materialized once, by ravel()
+    item_from_indices = np.broadcast_to(np.arange(num_items, dtype=np.int32)[:, None], (num_items, TOP_K)).ravel()
+    item_to_indices = all_similar_indices.ravel() # Already int32, and contiguous so this is a view
+    similarity_scores = all_similar_scores.ravel()
 
     sim_df = pl.DataFrame({
         "item_idx_from": item_from_indices,
@@ -128,6 +198,26 @@ try:
     sim_df.write_parquet(OUTPUT_SIMILARITY_FILE)
     logging.info("Similarity data saved.")
 
+    # --- Save the similarity matrix (CSR) ---
+    # Rows are already grouped by item, so the CSR arrays come straight from the
+    # top-K arrays: drop padding / non-positive entries and count what is left per row.
+    # Scores are stored as int16 (similarity * SIM_SCORE_SCALE), like the API's arrays.
+    logging.info(f"Saving similarity matrix to {OUTPUT_SIMILARITY_MATRIX_FILE}...")
+    valid = all_similar_scores > 0
+    sim_indptr = np.concatenate([[0], np.cumsum(valid.sum(axis=1))]).astype(np.int32)
+    sim_matrix = csr_matrix(
+        (quantize_scores(all_similar_scores[valid]), all_similar_indices[valid].astype(np.int32), sim_indptr),
+        shape=(num_items, num_items)
+    )
+    save_npz(OUTPUT_SIMILARITY_MATRIX_FILE, sim_matrix)
+    logging.info(f"Similarity matrix saved. nnz: {sim_matrix.nnz}")
+
+    # --- Prebuild the serving arrays for the API ---
+    logging.info(f"Building recommendation arrays with genre map {INPUT_GENRE_MAP_FILE}...")
+    genre_map_df = pl.read_parquet(INPUT_GENRE_MAP_FILE)
+    save_reco_arrays(build_reco_arrays(sim_df, genre_map_df), OUTPUT_RECO_DIR)
+    logging.info(f"Recommendation arrays saved. Copy {OUTPUT_RECO_DIR} to app/models/ to deploy them.")
+
 except ImportError:
      logging.error("Implicit library not found. Please install it: pip install implicit")
      exit(1)
@@ -6,65 +6,69 @@ import logging
 from pathlib import Path
 import time
 from tqdm import tqdm
+from concurrent.futures import ThreadPoolExecutor
 from sklearn.model_selection import train_test_split # Using sklearn for simplicity, though manual split is also possible
 
+try:
+    import torch # Optional: scores batches on the GPU (see requirements.yml)
+    USE_GPU = torch.cuda.is_available()
+except ImportError:
+    USE_GPU = False
+
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 
 # --- Configuration ---
 PROCESSED_DATA_DIR = Path("data/processed")
 RAW_DATA_DIR = Path("data/raw/ml-25m") # Need original ratings for timestamp split
 INPUT_MATRIX_FILE = PROCESSED_DATA_DIR / "user_item.npz"
-INPUT_SIMILARITY_FILE = PROCESSED_DATA_DIR / "sim.parquet"
+INPUT_SIMILARITY_FILE = PROCESSED_DATA_DIR / "sim.npz" # Top-K item-item similarities in CSR form (03_compute_sim.py)
+INPUT_USER_MAP_FILE = PROCESSED_DATA_DIR / "user_map.parquet" # Saved by 02_build_matrix.py
+INPUT_ITEM_MAP_FILE = PROCESSED_DATA_DIR / "item_map.parquet"
 RATINGS_FILE = RAW_DATA_DIR / "ratings.csv" # For timestamps
 K = 10 # Evaluate Hit@K and NDCG@K
 TEST_SIZE = 0.2 # Use 20% of interactions for testing
 
 # --- Check if input files exist ---
-if not INPUT_MATRIX_FILE.exists() or not INPUT_SIMILARITY_FILE.exists() or not RATINGS_FILE.exists():
-    logging.error(f"Required input files not found. Ensure matrix, similarity, and ratings files exist.")
+input_files = [INPUT_MATRIX_FILE, INPUT_SIMILARITY_FILE, INPUT_USER_MAP_FILE, INPUT_ITEM_MAP_FILE, RATINGS_FILE]
+if not all(f.exists() for f in input_files):
+    logging.error(f"Required input files not found. Ensure matrix, similarity, ID map, and ratings files exist.")
     exit(1)
 
 # --- Load Data ---
 logging.info("Loading data for evaluation...")
 try:
     user_item_matrix = load_npz(INPUT_MATRIX_FILE)
-    sim_df = pl.read_parquet(INPUT_SIMILARITY_FILE)
+    # Scores are stored as int16 (similarity * SIM_SCORE_SCALE). Ranking is scale-invariant,
+    # so they are used as-is, converted once to float32 to match the train matrix
+    # (mixing dtypes would make scipy upcast S again on every product).
+    sim_matrix = load_npz(INPUT_SIMILARITY_FILE).tocsr().astype(np.float32)
     ratings_df = pl.read_csv(RATINGS_FILE, columns=['userId', 'movieId', 'rating', 'timestamp'])
     logging.info("Data loaded.")
 
-    # Need the mapping from original IDs to matrix indices used in 02_build_matrix.py
-    # Recreate the maps based on the matrix dimensions or load them if saved previously.
-    # For simplicity, let's assume the matrix indices correspond directly to sorted unique IDs
-    # from the *filtered* ratings used in script 02. We need to reconstruct this mapping.
-
-    logging.info("Reconstructing ID maps based on the matrix...")
-    # Filter original ratings like in script 02
-    RATING_THRESHOLD = 3.5
-    implicit_df_orig = ratings_df.filter(pl.col("rating") >= RATING_THRESHOLD)
-
-    unique_users_orig = implicit_df_orig["userId"].unique().sort()
-    unique_movies_orig = implicit_df_orig["movieId"].unique().sort()
+    # Reuse the ID maps saved by 02_build_matrix.py, so the matrix indices match exactly
+    logging.info("Loading ID maps...")
+    user_map = pl.read_parquet(INPUT_USER_MAP_FILE).with_columns(pl.col("userId").cast(pl.Int64))
+    item_map = pl.read_parquet(INPUT_ITEM_MAP_FILE).with_columns(pl.col("movieId").cast(pl.Int64))
 
-    user_map_orig = {user_id: i for i, user_id in enumerate(unique_users_orig)}
-    movie_map_orig = {movie_id: i for i, movie_id in enumerate(unique_movies_orig)}
-    # Reverse maps
-    user_reverse_map = {i: user_id for user_id, i in user_map_orig.items()}
-    movie_reverse_map = {i: movie_id for movie_id, i in movie_map_orig.items()}
-
-    num_users = len(user_map_orig)
-    num_items = len(movie_map_orig)
+    num_users = len(user_map)
+    num_items = len(item_map)
 
     if user_item_matrix.shape != (num_users, num_items):
-         logging.warning(f"Matrix shape {user_item_matrix.shape} doesn't match reconstructed maps ({num_users}, {num_items}). Evaluation might be inaccurate.")
+         logging.warning(f"Matrix shape {user_item_matrix.shape} doesn't match the saved ID maps ({num_users}, {num_items}). Evaluation might be inaccurate.")
          # Adjust num_users/num_items if necessary, though this indicates a potential issue
          num_users, num_items = user_item_matrix.shape
 
-
-    # Map original ratings df to matrix indices for timestamp-based splitting
-    implicit_df_mapped = implicit_df_orig.with_columns([
-        pl.col("userId").map_dict(user_map_orig).alias("user_idx"),
-        pl.col("movieId").map_dict(movie_map_orig).alias("item_idx")
-    ]).select(["user_idx", "item_idx", "timestamp"])
+    # Filter original ratings like in script 02 and map them to matrix indices for
+    # timestamp-based splitting (hash joins on the ID columns, no Python dicts)
+    RATING_THRESHOLD = 3.5
+    implicit_df_mapped = (
+        ratings_df
+        .filter(pl.col("rating") >= RATING_THRESHOLD)
+        .with_columns(pl.col("userId").cast(pl.Int64), pl.col("movieId").cast(pl.Int64))
+        .join(user_map, on="userId", how="inner", maintain_order="left")
+        .join(item_map, on="movieId", how="inner", maintain_order="left")
+        .select(["user_idx", "item_idx", "timestamp"])
+    )
 
     logging.info("Data mapped for splitting.")
 
@@ -93,111 +97,124 @@ test_df = implicit_df_sorted.slice(n_train, n_test)
 
 # Create sparse matrices for train and test sets
 logging.info("Creating train and test sparse matrices...")
-train_data = np.ones(len(train_df), dtype=np.float32)
-train_matrix = csr_matrix((train_data, (train_df["user_idx"].to_numpy(), train_df["item_idx"].to_numpy())), shape=(num_users, num_items))
 
-test_data = np.ones(len(test_df), dtype=np.float32)
-test_matrix = csr_matrix((test_data, (test_df["user_idx"].to_numpy(), test_df["item_idx"].to_numpy())), shape=(num_users, num_items))
+def build_interaction_matrix(df):
+    """
+    CSR matrix of ones from the (user_idx, item_idx) rows of df. The arrays are
+    sorted by user once and handed to csr_matrix as (data, indices, indptr), which
+    skips the COO-to-CSR conversion (its sort and duplicate summing pass).
+    Each (user, movie) pair is rated at most once, so there are no duplicates.
+    """
+    df = df.sort("user_idx")
+    indptr = np.zeros(num_users + 1, dtype=np.int64)
+    np.cumsum(np.bincount(df["user_idx"].to_numpy(), minlength=num_users), out=indptr[1:])
+    indices = df["item_idx"].to_numpy().astype(np.int32)
+    data = np.ones(len(df), dtype=np.float32)
+    return csr_matrix((data, indices, indptr), shape=(num_users, num_items))
+
+train_matrix = build_interaction_matrix(train_df)
+test_matrix = build_interaction_matrix(test_df)
 
 logging.info(f"Train matrix shape: {train_matrix.shape}, nnz: {train_matrix.nnz}")
 logging.info(f"Test matrix shape: {test_matrix.shape}, nnz: {test_matrix.nnz}")
 
 
 # --- Prepare Similarity Data ---
-# Convert the similarity DataFrame into a more usable format, e.g., a dictionary or sparse matrix
-# For item-to-item, we need quick lookup of similar items for items in user history
-logging.info("Preparing similarity lookup...")
-# Pivot the table for easier lookup: item_idx_from -> list of (item_idx_to, similarity)
-sim_lookup = sim_df.group_by("item_idx_from").agg([
-    pl.col("item_idx_to").alias("similar_items"),
-    pl.col("similarity").alias("scores")
-]).sort("item_idx_from")
-
-# Convert to dictionary for faster access: {item_idx_from: (indices_array, scores_array)}
-sim_dict = {
-    row["item_idx_from"]: (np.array(row["similar_items"]), np.array(row["scores"]))
-    for row in tqdm(sim_lookup.iter_rows(named=True), total=len(sim_lookup), desc="Building lookup dict")
-}
-logging.info("Similarity lookup ready.")
-
-# --- Generate Recommendations ---
-logging.info(f"Generating Top-{K} recommendations for test users...")
-
-def get_recommendations_for_user(user_idx, train_user_items, k):
-    """Generates recommendations for a single user based on their training items."""
-    candidate_items = {} # {item_idx: score}
-
-    # Iterate through items the user interacted with in the training set
-    for item_idx in train_user_items:
-        if item_idx in sim_dict:
-            similar_items, scores = sim_dict[item_idx]
-            for sim_item_idx, score in zip(similar_items, scores):
-                # Aggregate scores (simple sum here, could use weighted sum)
-                candidate_items[sim_item_idx] = candidate_items.get(sim_item_idx, 0) + score
-
+# Item-item similarities as a sparse matrix S, so that train_matrix[users] @ S sums the
+# neighbour scores of every item in each user's history in one sparse product
+if sim_matrix.shape != (num_items, num_items):
+    logging.error(f"Similarity matrix shape {sim_matrix.shape} doesn't match {num_items} items. Please re-run 03_compute_sim.py.")
+    exit(1)
+logging.info(f"Similarity matrix ready. nnz: {sim_matrix.nnz}")
+
+# --- Generate Recommendations and Evaluate Metrics ---
+# Each batch is scored and evaluated in one pass, so only per-batch metric sums are kept
+logging.info(f"Generating Top-{K} recommendations and calculating Hit@{K} and NDCG@{K}...")
+BATCH_SIZE = 1024 # Users scored per sparse product; the dense score block is BATCH_SIZE x num_items
+# Batches run on threads: the sparse product, densifying and argpartition all release the GIL,
+# and threads share S and the train matrix without copying them into worker processes.
+# Each running batch holds its own dense score block, so this also bounds peak memory.
+# On the GPU, batches run one at a time; the device parallelizes each product itself.
+N_JOBS = 1 if USE_GPU else min(8, os.cpu_count() or 1)
+
+if USE_GPU:
+    logging.info("CUDA is available. Scoring batches on the GPU.")
+    # S^T as a CUDA sparse CSR tensor, so each batch is S^T @ dense(batch)^T (cuSPARSE SpMM)
+    sim_matrix_t = sim_matrix.T.tocsr()
+    sim_matrix_t_gpu = torch.sparse_csr_tensor(
+        torch.from_numpy(sim_matrix_t.indptr.astype(np.int64)),
+        torch.from_numpy(sim_matrix_t.indices.astype(np.int64)),
+        torch.from_numpy(sim_matrix_t.data.astype(np.float32)),
+        size=sim_matrix_t.shape, device="cuda"
+    )
+
+def top_k_gpu(batch_train, k):
+    """Top-k (indices, scores) per row of batch_train @ S, computed on the GPU."""
+    rows, cols = batch_train.nonzero()
+    rows = torch.from_numpy(rows.astype(np.int64)).cuda()
+    cols = torch.from_numpy(cols.astype(np.int64)).cuda()
+    batch_dense_t = torch.zeros((num_items, batch_train.shape[0]), dtype=torch.float32, device="cuda")
+    batch_dense_t[cols, rows] = torch.from_numpy(batch_train.data.astype(np.float32)).cuda()
+    batch_scores = torch.sparse.mm(sim_matrix_t_gpu, batch_dense_t).T
     # Remove items already interacted with in the training set
-    for item_idx in train_user_items:
-        if item_idx in candidate_items:
-            del candidate_items[item_idx]
-
-    # Sort candidates by score and take top K
-    sorted_items = sorted(candidate_items.items(), key=lambda item: item[1], reverse=True)
-    recommendations = [item_idx for item_idx, score in sorted_items[:k]]
-    return recommendations
-
-# Get users present in the test set
-test_user_indices = np.unique(test_matrix.nonzero()[0])
-all_recommendations = {}
-train_matrix_lil = train_matrix.tolil() # Efficient row slicing
-test_matrix_lil = test_matrix.tolil()
-
-for user_idx in tqdm(test_user_indices, desc="Generating recommendations"):
-    train_items = train_matrix_lil.rows[user_idx]
-    if not train_items: # Skip users with no history in train set
-        continue
-    recs = get_recommendations_for_user(user_idx, train_items, K)
-    all_recommendations[user_idx] = recs
-
-
-# --- Evaluate Metrics ---
-logging.info(f"Calculating Hit@{K} and NDCG@{K}...")
-hits = 0
-total_relevant_interactions = 0
-ndcg_sum = 0.0
-
-for user_idx in tqdm(test_user_indices, desc="Evaluating metrics"):
-    if user_idx not in all_recommendations:
-        continue # Skip users for whom recommendations couldn't be generated
-
-    recommended_items = all_recommendations[user_idx]
-    true_items = test_matrix_lil.rows[user_idx] # Items user interacted with in test set
-
-    if not true_items: # Skip users with no interactions in test set
-        continue
-
-    total_relevant_interactions += len(true_items)
-    relevant_set = set(true_items)
-    recommended_set = set(recommended_items)
+    batch_scores[rows, cols] = -float("inf")
+    top_scores, top_k = torch.topk(batch_scores, k, dim=1) # Sorted best first
+    return top_k.cpu().numpy(), top_scores.cpu().numpy()
+
+DISCOUNTS = 1.0 / np.log2(np.arange(2, K + 2)) # Position i (0-based) is discounted by log2(i + 2)
+IDCG_CUM = np.concatenate(([0.0], np.cumsum(DISCOUNTS))) # IDCG_CUM[n]: ideal DCG with n relevant items
+
+# Get users present in the test set, skipping users with no history in the train set
+# (row lengths come straight from the CSR indptr, no COO copy of the matrices)
+test_user_indices = np.flatnonzero((np.diff(test_matrix.indptr) > 0) & (np.diff(train_matrix.indptr) > 0))
+num_test_users_evaluated = len(test_user_indices) # Users for whom recs are generated
+
+def evaluate_batch(start):
+    """Returns (hits, NDCG sum) for the users in test_user_indices[start:start + BATCH_SIZE]."""
+    user_batch = test_user_indices[start:start + BATCH_SIZE]
+    batch_train = train_matrix[user_batch]
+    k = min(K, num_items)
+    if USE_GPU:
+        top_k, top_scores = top_k_gpu(batch_train, k)
+    else:
+        batch_scores = (batch_train @ sim_matrix).toarray()
+        # Remove items already interacted with in the training set
+        batch_scores[batch_train.nonzero()] = -np.inf
+
+        # Top K per row: argpartition picks the K best unordered, then only those K are sorted
+        top_k = np.argpartition(-batch_scores, k - 1, axis=1)[:, :k]
+        top_scores = np.take_along_axis(batch_scores, top_k, axis=1)
+        order = np.argsort(-top_scores, axis=1, kind="stable")
+        top_k = np.take_along_axis(top_k, order, axis=1)
+        top_scores = np.take_along_axis(top_scores, order, axis=1)
+
+    # Only items reached through a similar item are candidates (-1 marks an empty slot)
+    recommendations = np.where(top_scores > 0, top_k, -1)
+
+    # Encode (row, item) pairs as row * num_items + item, so checking which recommendations
+    # are relevant is a single membership test against the batch's test CSR entries
+    batch_test = test_matrix[user_batch] # Items each user interacted with in test set
+    test_counts = np.diff(batch_test.indptr)
+    row_ids = np.arange(len(user_batch), dtype=np.int64)
+    test_keys = np.repeat(row_ids, test_counts) * num_items + batch_test.indices
+    rec_keys = row_ids[:, None] * num_items + recommendations
+    hits_mat = (recommendations >= 0) & np.isin(rec_keys, test_keys) # (users, k) bool
 
     # Hit Rate
-    hit = len(relevant_set.intersection(recommended_set)) > 0
-    if hit:
-        hits += 1
+    hits = int(hits_mat.any(axis=1).sum())
 
     # NDCG
-    dcg = 0.0
-    for i, item_idx in enumerate(recommended_items):
-        if item_idx in relevant_set:
-            dcg += 1.0 / np.log2(i + 2) # i+2 because index is 0-based
-
-    idcg = 0.0
-    for i in range(min(len(true_items), K)):
-        idcg += 1.0 / np.log2(i + 2)
+    dcg = hits_mat @ DISCOUNTS[:k]
+    idcg = IDCG_CUM[np.minimum(test_counts, K)]
+    ndcg_sum = float((dcg / idcg).sum()) # Every evaluated user has at least one test item
+    return hits, ndcg_sum
 
-    ndcg = dcg / idcg if idcg > 0 else 0.0
-    ndcg_sum += ndcg
+batch_starts = range(0, num_test_users_evaluated, BATCH_SIZE)
+with ThreadPoolExecutor(max_workers=N_JOBS) as executor:
+    batch_results = list(tqdm(executor.map(evaluate_batch, batch_starts), total=len(batch_starts), desc="Evaluating batches"))
+hits = sum(batch_hits for batch_hits, _ in batch_results)
+ndcg_sum = sum(batch_ndcg for _, batch_ndcg in batch_results)
 
-num_test_users_evaluated = len(all_recommendations) # Users for whom recs were generated
 hit_rate = hits / num_test_users_evaluated if num_test_users_evaluated > 0 else 0.0
 average_ndcg = ndcg_sum / num_test_users_evaluated if num_test_users_evaluated > 0 else 0.0
 
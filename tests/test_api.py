@@ -1,4 +1,5 @@
 import pytest
+import pytest_asyncio
 import httpx # Async HTTP client for testing FastAPI
 import sys
 from pathlib import Path
@@ -12,147 +13,239 @@ import random
 # Assumes the application is running via docker-compose on http://localhost
 BASE_URL = "http://localhost/api" # Use the Nginx proxy URL
 
+# All tests share one event loop, so they can share the session-scoped client below
+pytestmark = pytest.mark.asyncio(loop_scope="session")
+
+# --- Fixtures ---
+
+@pytest_asyncio.fixture(scope="session", loop_scope="session")
+async def client():
+    """One AsyncClient for the whole run, reusing its keep-alive connections."""
+    async with httpx.AsyncClient(base_url=BASE_URL, timeout=10.0) as c:
+        yield c
+
 # --- Test Cases ---
 
-@pytest.mark.asyncio # Mark test as async
-async def test_get_genres_api():
+async def test_get_genres_api(client):
     """Tests the /genres endpoint."""
-    async with httpx.AsyncClient() as client:
-        try:
-            response = await client.get(f"{BASE_URL}/genres")
-            response.raise_for_status() # Raise exception for 4xx or 5xx status codes
-            data = response.json()
-
-            assert response.status_code == 200
-            assert "genres" in data
-            assert isinstance(data["genres"], list)
-            assert len(data["genres"]) > 0
-            assert "Action" in data["genres"] # Check for expected genre
-
-        except httpx.RequestError as e:
-            pytest.fail(f"API request failed: {e}. Is the service running via docker compose?")
-        except Exception as e:
-             pytest.fail(f"An unexpected error occurred: {e}")
-
-
-@pytest.mark.asyncio
-async def test_get_random_api_valid_genre():
-    """Tests the /random endpoint with a valid genre."""
-    genre = "Drama" # Assume Drama exists
-    async with httpx.AsyncClient() as client:
-        try:
-            response = await client.get(f"{BASE_URL}/random?genre={genre}")
-            response.raise_for_status()
-            data = response.json()
+    try:
+        response = await client.get("/genres")
+        response.raise_for_status() # Raise exception for 4xx or 5xx status codes
+        data = response.json()
 
-            assert response.status_code == 200
-            assert "recommendations" in data
-            assert isinstance(data["recommendations"], list)
-            # API should return RECOMMENDATION_COUNT (20) movies if available
-            assert len(data["recommendations"]) <= 20
-            if data["recommendations"]:
-                 assert "movieId" in data["recommendations"][0]
-                 assert "title" in data["recommendations"][0]
+        assert response.status_code == 200
+        assert "genres" in data
+        assert isinstance(data["genres"], list)
+        assert len(data["genres"]) > 0
+        assert "Action" in data["genres"] # Check for expected genre
 
-        except httpx.RequestError as e:
-            pytest.fail(f"API request failed: {e}")
-        except Exception as e:
-             pytest.fail(f"An unexpected error occurred: {e}")
+    except httpx.RequestError as e:
+        pytest.fail(f"API request failed: {e}. Is the service running via docker compose?")
+    except Exception as e:
+         pytest.fail(f"An unexpected error occurred: {e}")
 
 
-@pytest.mark.asyncio
-async def test_get_random_api_invalid_genre():
+async def test_get_random_api_valid_genre(client):
+    """Tests the /random endpoint with a valid genre."""
+    genre = "Drama" # Assume Drama exists
+    try:
+        response = await client.get(f"/random?genre={genre}")
+        response.raise_for_status()
+        data = response.json()
+
+        assert response.status_code == 200
+        assert "recommendations" in data
+        assert isinstance(data["recommendations"], list)
+        # API should return RECOMMENDATION_COUNT (20) movies if available
+        assert len(data["recommendations"]) <= 20
+        if data["recommendations"]:
+             assert "movieId" in data["recommendations"][0]
+             assert "title" in data["recommendations"][0]
+
+    except httpx.RequestError as e:
+        pytest.fail(f"API request failed: {e}")
+    except Exception as e:
+         pytest.fail(f"An unexpected error occurred: {e}")
+
+
+async def test_get_random_api_invalid_genre(client):
     """Tests the /random endpoint with an invalid genre."""
     genre = "InvalidGenreForTesting123"
-    async with httpx.AsyncClient() as client:
-        try:
-            response = await client.get(f"{BASE_URL}/random?genre={genre}")
-            # Expecting a 404 Not Found error
-            assert response.status_code == 404
-            data = response.json()
-            assert "detail" in data
-            assert genre in data["detail"] # Check if error message mentions the genre
-
-        except httpx.RequestError as e:
-            pytest.fail(f"API request failed: {e}")
-        except Exception as e:
-             pytest.fail(f"An unexpected error occurred: {e}")
-
-
-@pytest.mark.asyncio
-async def test_post_choice_api_and_session():
+    try:
+        response = await client.get(f"/random?genre={genre}")
+        # Expecting a 404 Not Found error
+        assert response.status_code == 404
+        data = response.json()
+        assert "detail" in data
+        assert genre in data["detail"] # Check if error message mentions the genre
+
+    except httpx.RequestError as e:
+        pytest.fail(f"API request failed: {e}")
+    except Exception as e:
+         pytest.fail(f"An unexpected error occurred: {e}")
+
+
+async def test_get_genres_api_not_modified(client):
+    """Tests that /genres answers 304 with an empty body when the client sends its ETag."""
+    try:
+        response = await client.get("/genres")
+        response.raise_for_status()
+        etag = response.headers.get("etag")
+        assert etag is not None, "/genres did not return an ETag"
+
+        response_cached = await client.get("/genres", headers={"If-None-Match": etag})
+        assert response_cached.status_code == 304
+        assert response_cached.content == b""
+        assert response_cached.headers.get("etag") == etag
+
+    except httpx.RequestError as e:
+        pytest.fail(f"API request failed: {e}")
+
+
+async def test_get_random_api_cached_sample(client):
+    """Tests that /random reuses the same sample (body and ETag) within RANDOM_MAX_AGE."""
+    genre = "Drama"
+    try:
+        response1 = await client.get(f"/random?genre={genre}")
+        response2 = await client.get(f"/random?genre={genre}")
+        response1.raise_for_status()
+        response2.raise_for_status()
+
+        assert response1.headers.get("etag") is not None
+        assert response1.headers.get("etag") == response2.headers.get("etag")
+        assert response1.content == response2.content
+
+    except httpx.RequestError as e:
+        pytest.fail(f"API request failed: {e}")
+
+
+async def test_tampered_session_cookie_replaced(client):
+    """Tests that a session cookie with a bad signature is ignored and replaced by a newly signed one."""
+    client.cookies.clear()
+    try:
+        response_random = await client.get("/random?genre=Comedy")
+        response_random.raise_for_status()
+        random_movies = response_random.json()["recommendations"]
+        if not random_movies:
+            pytest.skip("No movies found for genre Comedy, cannot proceed with cookie test.")
+        movie_id = random_movies[0]["movieId"]
+
+        # Get a validly signed cookie, then corrupt its signature
+        response_choice = await client.post("/choice", json={"movieId": movie_id})
+        response_choice.raise_for_status()
+        signed_cookie = response_choice.cookies.get("reco_session_id")
+        assert signed_cookie is not None and "." in signed_cookie
+        tampered_cookie = signed_cookie[:-1] + ("A" if signed_cookie[-1] != "A" else "B")
+
+        client.cookies.clear()
+        client.cookies.set("reco_session_id", tampered_cookie)
+        response_tampered = await client.post("/choice", json={"movieId": movie_id})
+        response_tampered.raise_for_status()
+        new_cookie = response_tampered.cookies.get("reco_session_id")
+        assert new_cookie is not None, "Tampered cookie was accepted instead of replaced"
+        assert new_cookie not in (tampered_cookie, signed_cookie)
+
+        # The replacement is a valid session: using it doesn't mint another one
+        client.cookies.clear()
+        client.cookies.set("reco_session_id", new_cookie)
+        response_reused = await client.post("/choice", json={"movieId": movie_id})
+        response_reused.raise_for_status()
+        assert "set-cookie" not in response_reused.headers
+
+    except httpx.RequestError as e:
+        pytest.fail(f"API request failed: {e}")
+    finally:
+        client.cookies.clear()
+
+
+async def test_no_session_cookie_outside_choice(client):
+    """Tests that only /choice creates sessions: /genres, /random and a cookieless /reset set no cookie."""
+    client.cookies.clear()
+    try:
+        response_genres = await client.get("/genres")
+        response_random = await client.get("/random?genre=Drama")
+        response_reset = await client.post("/reset")
+        for response in (response_genres, response_random, response_reset):
+            response.raise_for_status()
+            assert "set-cookie" not in response.headers, f"{response.url} set a cookie"
+
+    except httpx.RequestError as e:
+        pytest.fail(f"API request failed: {e}")
+
+
+async def test_post_choice_api_and_session(client):
     """
     Tests the /choice endpoint and basic session handling.
     Requires Redis to be running and accessible by the API container.
     """
-    async with httpx.AsyncClient() as client:
-        try:
-            # 1. Get initial random recommendations to find a valid movie ID
-            genre = "Comedy"
-            response_random = await client.get(f"{BASE_URL}/random?genre={genre}")
-            response_random.raise_for_status()
-            random_movies = response_random.json()["recommendations"]
-            if not random_movies:
-                pytest.skip(f"No movies found for genre {genre}, cannot proceed with choice test.")
-            
-            test_movie_id = random_movies[0]["movieId"]
-            test_movie_title = random_movies[0]["title"]
-            print(f"\nUsing movie for choice test: ID={test_movie_id}, Title='{test_movie_title}'")
-
-            # 2. Post the choice
-            response_choice1 = await client.post(f"{BASE_URL}/choice", json={"movieId": test_movie_id})
-            response_choice1.raise_for_status()
-            data_choice1 = response_choice1.json()
-
-            assert response_choice1.status_code == 200
-            assert "recommendations" in data_choice1
-            assert isinstance(data_choice1["recommendations"], list)
-            # Check if the chosen movie is NOT in the recommendations
-            assert test_movie_id not in [m["movieId"] for m in data_choice1["recommendations"]]
-            
-            # Extract the session cookie set by the server
-            session_cookie = response_choice1.cookies.get( "reco_session_id")
-            assert session_cookie is not None, "Session cookie was not set in the response"
-            print(f"Session cookie received: {session_cookie}")
-
-            # 3. Post another choice using the same session (via cookie)
-            # Find another movie ID from the first choice's recommendations
-            if not data_choice1["recommendations"]:
-                 pytest.skip("First choice returned no recommendations, cannot test second choice.")
-            
-            second_movie_id = data_choice1["recommendations"][0]["movieId"]
-            print(f"Using second movie for choice test: ID={second_movie_id}")
-
-            # Ensure the client sends the cookie back
-            cookies = { "reco_session_id": session_cookie }
-            response_choice2 = await client.post(f"{BASE_URL}/choice", json={"movieId": second_movie_id}, cookies=cookies)
-            response_choice2.raise_for_status()
-            data_choice2 = response_choice2.json()
-
-            assert response_choice2.status_code == 200
-            assert "recommendations" in data_choice2
-            # Check if both chosen movies are NOT in the new recommendations
-            history_set = {test_movie_id, second_movie_id}
-            assert all(m["movieId"] not in history_set for m in data_choice2["recommendations"])
-
-            # 4. Test reset endpoint
-            response_reset = await client.post(f"{BASE_URL}/reset", cookies=cookies)
-            response_reset.raise_for_status()
-            data_reset = response_reset.json()
-            assert response_reset.status_code == 200
-            assert "message" in data_reset
-
-            # 5. Post choice again after reset - should be like the first choice
-            response_choice3 = await client.post(f"{BASE_URL}/choice", json={"movieId": test_movie_id}, cookies=cookies)
-            response_choice3.raise_for_status()
-            data_choice3 = response_choice3.json()
-            # Compare recommendations with the first choice (might not be identical due to randomness/updates, but structure should match)
-            assert len(data_choice3["recommendations"]) == len(data_choice1["recommendations"])
-
-
-        except httpx.RequestError as e:
-            pytest.fail(f"API request failed: {e}. Is Redis running and accessible?")
-        except Exception as e:
-             pytest.fail(f"An unexpected error occurred: {e}")
+    client.cookies.clear() # The shared client may hold a session cookie from an earlier test
+    try:
+        # 1. Get initial random recommendations to find a valid movie ID
+        genre = "Comedy"
+        response_random = await client.get(f"/random?genre={genre}")
+        response_random.raise_for_status()
+        random_movies = response_random.json()["recommendations"]
+        if not random_movies:
+            pytest.skip(f"No movies found for genre {genre}, cannot proceed with choice test.")
+        
+        test_movie_id = random_movies[0]["movieId"]
+        test_movie_title = random_movies[0]["title"]
+        print(f"\nUsing movie for choice test: ID={test_movie_id}, Title='{test_movie_title}'")
+
+        # 2. Post the choice
+        response_choice1 = await client.post("/choice", json={"movieId": test_movie_id})
+        response_choice1.raise_for_status()
+        data_choice1 = response_choice1.json()
+
+        assert response_choice1.status_code == 200
+        assert "recommendations" in data_choice1
+        assert isinstance(data_choice1["recommendations"], list)
+        # Check if the chosen movie is NOT in the recommendations
+        assert test_movie_id not in [m["movieId"] for m in data_choice1["recommendations"]]
+        
+        # Extract the session cookie set by the server
+        session_cookie = response_choice1.cookies.get( "reco_session_id")
+        assert session_cookie is not None, "Session cookie was not set in the response"
+        print(f"Session cookie received: {session_cookie}")
+
+        # 3. Post another choice using the same session (via cookie)
+        # Find another movie ID from the first choice's recommendations
+        if not data_choice1["recommendations"]:
+             pytest.skip("First choice returned no recommendations, cannot test second choice.")
+        
+        second_movie_id = data_choice1["recommendations"][0]["movieId"]
+        print(f"Using second movie for choice test: ID={second_movie_id}")
+
+        # Ensure the client sends the cookie back
+        cookies = { "reco_session_id": session_cookie }
+        response_choice2 = await client.post("/choice", json={"movieId": second_movie_id}, cookies=cookies)
+        response_choice2.raise_for_status()
+        data_choice2 = response_choice2.json()
+
+        assert response_choice2.status_code == 200
+        assert "recommendations" in data_choice2
+        # Check if both chosen movies are NOT in the new recommendations
+        history_set = {test_movie_id, second_movie_id}
+        assert all(m["movieId"] not in history_set for m in data_choice2["recommendations"])
+
+        # 4. Test reset endpoint
+        response_reset = await client.post("/reset", cookies=cookies)
+        response_reset.raise_for_status()
+        data_reset = response_reset.json()
+        assert response_reset.status_code == 200
+        assert "message" in data_reset
+
+        # 5. Post choice again after reset - should be like the first choice
+        response_choice3 = await client.post("/choice", json={"movieId": test_movie_id}, cookies=cookies)
+        response_choice3.raise_for_status()
+        data_choice3 = response_choice3.json()
+        # Compare recommendations with the first choice (might not be identical due to randomness/updates, but structure should match)
+        assert len(data_choice3["recommendations"]) == len(data_choice1["recommendations"])
+
+
+    except httpx.RequestError as e:
+        pytest.fail(f"API request failed: {e}. Is Redis running and accessible?")
+    except Exception as e:
+         pytest.fail(f"An unexpected error occurred: {e}")
 
 # Add more tests, e.g., for missing parameters, invalid request bodies etc.
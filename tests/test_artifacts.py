@@ -0,0 +1,66 @@
+import pytest
+import sys
+from pathlib import Path
+
+import numpy as np
+import polars as pl
+
+# Add the project root to the Python path to allow imports like 'from app import artifacts'
+project_root = Path(__file__).parent.parent
+sys.path.insert(0, str(project_root))
+
+from app import artifacts
+
+
+# --- Fixtures ---
+
+@pytest.fixture
+def small_model():
+    """A tiny similarity table and genre map with three movies."""
+    sim_df = pl.DataFrame({
+        "item_idx_from": [0, 0, 1, 2],
+        "item_idx_to": [1, 2, 0, 0],
+        "similarity": [0.5, 0.9, 0.5, 0.9],
+    })
+    genre_map_df = pl.DataFrame({
+        "movieId": [10, 20, 30],
+        "item_idx": [0, 1, 2],
+        "title": ["Alpha (1999)", "Bêta (2001)", "Gamma (2010)"],
+        "genres": ["Action|Comedy", "Comedy", "(no genres listed)"],
+    })
+    return sim_df, genre_map_df
+
+
+# --- Test Cases ---
+
+def test_build_reco_arrays(small_model):
+    """Tests the CSR layouts and lookups produced from the parquet tables."""
+    arrays = artifacts.build_reco_arrays(*small_model)
+
+    # Neighbours are sorted by similarity descending within each item
+    assert arrays["sim_indptr"].tolist() == [0, 2, 3, 4]
+    assert arrays["sim_neighbors"].tolist() == [2, 1, 0, 0]
+    # Scores are quantized to int16
+    assert arrays["sim_scores"].dtype == np.int16
+    assert arrays["sim_scores"].tolist() == [29490, 16384, 16384, 29490]
+
+    genre_names = arrays["genre_names"].tolist()
+    assert genre_names == ["Action", "Comedy"] # "(no genres listed)" is skipped
+    comedy = genre_names.index("Comedy")
+    start, end = arrays["genre_indptr"][comedy], arrays["genre_indptr"][comedy + 1]
+    assert sorted(arrays["genre_items"][start:end].tolist()) == [0, 1]
+
+    assert arrays["movie_ids"].tolist() == [10, 20, 30]
+    offsets = arrays["title_offsets"]
+    assert arrays["title_bytes"][offsets[1]:offsets[2]].tobytes().decode("utf-8") == "Bêta (2001)"
+
+
+def test_save_and_load_reco_arrays(small_model, tmp_path):
+    """Tests that saved arrays are memory-mapped back unchanged."""
+    arrays = artifacts.build_reco_arrays(*small_model)
+    artifacts.save_reco_arrays(arrays, tmp_path / "reco")
+    loaded = artifacts.load_reco_arrays(tmp_path / "reco")
+
+    assert set(loaded) == set(artifacts.ARRAY_NAMES)
+    for name in artifacts.ARRAY_NAMES:
+        np.testing.assert_array_equal(loaded[name], arrays[name])
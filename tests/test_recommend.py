@@ -3,6 +3,8 @@ import sys
 import os
 from pathlib import Path
 
+import numpy as np
+
 # Add the app directory to the Python path to allow imports like 'from app import recommend'
 # This assumes tests are run from the project root directory
 project_root = Path(__file__).parent.parent
@@ -113,4 +115,22 @@ def test_recommend_top_k_empty_history():
     assert isinstance(recommendations, list)
     assert len(recommendations) == 0
 
+def test_agg_topk_matches_numpy_kernel():
+    """Tests that the (possibly Numba-compiled) kernel agrees with the NumPy fallback."""
+    if not recommend.sim_neighbors.size:
+        pytest.skip("Similarity data not loaded, skipping test.")
+
+    history = np.array([0, 1, 2], dtype=np.int32)
+    n = 10
+    fast = recommend._agg_topk(recommend.sim_indptr, recommend.sim_neighbors, recommend.sim_scores, history, n)
+    reference = recommend._agg_topk_numpy(recommend.sim_indptr, recommend.sim_neighbors, recommend.sim_scores, history, n)
+
+    # Compare aggregated scores rather than indices, so ties may be broken differently
+    neighbors = np.concatenate([recommend.sim_neighbors[recommend.sim_indptr[i]:recommend.sim_indptr[i + 1]] for i in history])
+    scores = np.concatenate([recommend.sim_scores[recommend.sim_indptr[i]:recommend.sim_indptr[i + 1]] for i in history])
+    aggregated = np.bincount(neighbors, weights=scores)
+    assert len(fast) == len(reference)
+    assert np.allclose(aggregated[fast], aggregated[reference], atol=1e-5)
+    assert not set(fast.tolist()) & set(history.tolist())
+
 # Add more tests as needed, e.g., for edge cases in _get_movie_details